@@ -0,0 +1,217 @@
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator
+
+from tqdm import tqdm
+
+import face_processor
+import id_creator
+import layout
+
+# Columns accepted in a roster file and their defaults when left out
+ROSTER_DEFAULTS = {
+    "target_face_size": 0.5,
+    "face_num": 1,
+    "force_image": False,
+}
+ROSTER_REQUIRED = ("name", "phone", "post", "photo")
+
+
+# Interpret the usual spreadsheet spellings of a boolean
+def parse_bool(value: str | bool) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "y")
+
+
+# Read a roster of members from a CSV or JSON file
+def load_roster(roster_path: str) -> list[dict]:
+    if roster_path.lower().endswith(".json"):
+        with open(roster_path, encoding="utf-8") as f:
+            rows = json.load(f)
+    else:
+        with open(roster_path, newline="", encoding="utf-8-sig") as f:
+            rows = list(csv.DictReader(f))
+
+    # Photo and template paths in the roster are relative to the roster file
+    roster_dir = os.path.dirname(os.path.abspath(roster_path))
+
+    roster = []
+    for row in rows:
+        row = {key.strip().lower(): value for key, value in row.items() if key}
+        if row.get("photo"):
+            row["photo"] = os.path.join(roster_dir, str(row["photo"]).strip())
+        if row.get("template") and row["template"] != layout.DEFAULT_TEMPLATE:
+            row["template"] = os.path.join(roster_dir, str(row["template"]).strip())
+        roster.append(row)
+
+    return roster
+
+
+# Roster row values with the defaults filled in for columns left out or empty,
+# including cells missing from short CSV rows and JSON nulls
+def row_options(row: dict) -> dict:
+    return {**ROSTER_DEFAULTS, **{k: v for k, v in row.items() if v not in ("", None)}}
+
+
+# Columns a roster row is missing
+def missing_columns(row: dict) -> list[str]:
+    return [key for key in ROSTER_REQUIRED if not str(row.get(key) or "").strip()]
+
+
+# Generate a single card from a roster row, never raising
+def generate_row(row_num: int, row: dict) -> tuple[int, str | None, str]:
+    missing = missing_columns(row)
+    if missing:
+        return row_num, None, f"Missing column(s): {', '.join(missing)}"
+
+    options = row_options(row)
+
+    try:
+        output_path, message = id_creator.generate_id_card(
+            row["photo"],
+            float(options["target_face_size"]),
+            int(options["face_num"]),
+            parse_bool(options["force_image"]),
+            str(row["name"]),
+            str(row["phone"]),
+            str(row["post"]),
+            options.get("template") or None,
+        )
+    except Exception as e:
+        return row_num, None, f"{type(e).__name__}: {e}"
+
+    return row_num, output_path, message
+
+
+# Generate the cards of several rows sharing one group photo, so the photo is
+# read, decoded and searched for faces once. A bad row fails on its own. Never raises
+def generate_group(
+    rows: list[tuple[int, dict]],
+) -> list[tuple[int, str | None, str]]:
+    results = {}
+    members = []
+    for row_num, row in rows:
+        options = row_options(row)
+        try:
+            members.append(
+                (
+                    row_num,
+                    {
+                        "name": str(row["name"]),
+                        "phone": str(row["phone"]),
+                        "post": str(row["post"]),
+                        "face_num": int(options["face_num"]),
+                        "target_face_size": float(options["target_face_size"]),
+                        "template": options.get("template") or None,
+                    },
+                )
+            )
+        except (TypeError, ValueError) as e:
+            results[row_num] = (None, f"{type(e).__name__}: {e}")
+
+    if members:
+        try:
+            cards = id_creator.generate_group_id_cards(
+                rows[0][1]["photo"], [member for _, member in members]
+            )
+        except Exception as e:
+            # Only a problem with the shared photo, such as being unreadable, fails
+            # every row
+            cards = [(None, f"{type(e).__name__}: {e}")] * len(members)
+
+        for (row_num, _), card in zip(members, cards):
+            results[row_num] = card
+
+    return [(row_num, *results[row_num]) for row_num, _ in rows]
+
+
+# Split the roster into work items: rows that crop faces from the same photo are
+# grouped together, everything else is generated on its own
+def plan_batch(roster: list[dict]) -> list[list[tuple[int, dict]]]:
+    groups: dict[str, list[tuple[int, dict]]] = {}
+    items = []
+    for row_num, row in enumerate(roster, start=1):
+        try:
+            groupable = not missing_columns(row) and not parse_bool(
+                row_options(row)["force_image"]
+            )
+        except ValueError:
+            groupable = False
+
+        if not groupable:
+            items.append([(row_num, row)])
+            continue
+
+        photo = os.path.abspath(row["photo"])
+        if photo not in groups:
+            groups[photo] = []
+            items.append(groups[photo])
+        groups[photo].append((row_num, row))
+
+    return items
+
+
+# Run one work item from plan_batch
+def generate_item(
+    item: list[tuple[int, dict]],
+) -> list[tuple[int, str | None, str]]:
+    if len(item) == 1:
+        return [generate_row(*item[0])]
+    return generate_group(item)
+
+
+# Generate every card in the roster across worker processes,
+# yielding (row number, output path, message) as each row finishes
+def generate_batch(
+    roster: list[dict], workers: int | None = None
+) -> Iterator[tuple[int, str | None, str]]:
+    # Each process detects one photo at a time, OpenCV's threads share out the cores
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=face_processor.configure_detectors,
+        initargs=(1, face_processor.opencv_threads(workers)),
+    ) as executor:
+        futures = {
+            executor.submit(generate_item, item): item for item in plan_batch(roster)
+        }
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                # Even a worker process dying fails its item's rows, not the batch
+                message = f"{type(e).__name__}: {e}"
+                results = [(row_num, None, message) for row_num, _ in futures[future]]
+            yield from results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate ID cards for every member in a CSV/JSON roster"
+    )
+    parser.add_argument(
+        "roster", help="Roster file with name, phone, post and photo columns"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Worker processes (default: CPUs)"
+    )
+    args = parser.parse_args()
+
+    roster = load_roster(args.roster)
+
+    failed = 0
+    for row_num, output_path, message in tqdm(
+        generate_batch(roster, args.workers),
+        total=len(roster),
+        desc="Generating cards",
+        unit="card(s) ",
+    ):
+        if output_path is None:
+            failed += 1
+            tqdm.write(f"Row {row_num}: {message}")
+
+    print(f"{len(roster) - failed} card(s) generated, {failed} failed.")
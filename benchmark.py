@@ -0,0 +1,681 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+
+# Peak resident set size of the current process in MB
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# Build a synthetic grayscale photo with smooth shading, texture and a few blobs
+def make_gray_photo(width: int, height: int, seed: int = 0) -> np.ndarray:
+    import cv2
+
+    rng = np.random.default_rng(seed)
+
+    # Shade a small base image and upscale it so building the photo stays cheap
+    small_w, small_h = max(1, width // 8), max(1, height // 8)
+    yy, xx = np.mgrid[0:small_h, 0:small_w].astype(np.float32)
+    base = 96 + 64 * np.sin(xx / 12) * np.cos(yy / 16)
+
+    for _ in range(5):
+        cx, cy = rng.integers(0, small_w), rng.integers(0, small_h)
+        radius = rng.integers(
+            min(small_w, small_h) // 20 + 1, min(small_w, small_h) // 6 + 2
+        )
+        base[(xx - cx) ** 2 + (yy - cy) ** 2 < radius**2] += 60
+
+    image = cv2.resize(
+        np.clip(base, 0, 255).astype(np.uint8),
+        (width, height),
+        interpolation=cv2.INTER_CUBIC,
+    )
+    noise = rng.integers(0, 24, (height, width), dtype=np.uint8)
+    return cv2.add(image, noise)
+
+
+# Load a real photo as grayscale, resized to the requested size
+def load_gray_photo(path: str, width: int, height: int) -> np.ndarray:
+    with Image.open(path) as image:
+        return np.array(image.convert("L").resize((width, height)))
+
+
+# Time face detection in a fresh process so peak memory is measured per mode
+def _detection_run(
+    width: int, height: int, max_side: int, refine: bool, repeats: int, photo: str
+) -> dict:
+    import face_processor
+
+    if photo:
+        gray = load_gray_photo(photo, width, height)
+    else:
+        gray = make_gray_photo(width, height)
+
+    rss_before = peak_rss_mb()
+    latencies = []
+    faces = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        faces = face_processor.detect_faces(gray, max_side=max_side, refine=refine)
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        "size": f"{width}x{height}",
+        "mode": f"max_side={max_side or 'full'} refine={refine}",
+        "median_ms": statistics.median(latencies) * 1000,
+        "min_ms": min(latencies) * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_delta_mb": peak_rss_mb() - rss_before,
+        "faces": len(faces),
+    }
+
+
+# Compare full-resolution detection against the downscaled detection path
+def bench_detection(
+    sizes: list[tuple[int, int]], repeats: int, photo: str, max_side: int
+):
+    modes = [(0, False), (max_side, False), (max_side, True)]
+
+    # A spawned process per run keeps memory peaks independent of each other
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for width, height in sizes:
+            for mode_max_side, refine in modes:
+                result = pool.apply(
+                    _detection_run,
+                    (width, height, mode_max_side, refine, repeats, photo),
+                )
+                print(
+                    f"{result['size']:>11} | {result['mode']:<28} | "
+                    f"median {result['median_ms']:8.1f} ms | "
+                    f"min {result['min_ms']:8.1f} ms | "
+                    f"peak RSS {result['peak_rss_mb']:7.1f} MB "
+                    f"(+{result['peak_rss_delta_mb']:.1f}) | "
+                    f"{result['faces']} face(s)"
+                )
+
+
+# Detect faces in count photos from threads at once in a fresh process,
+# with the detector pool sized for that many threads
+def _scaling_run(
+    threads: int, opencv_threads: int, count: int, width: int, height: int
+) -> dict:
+    from concurrent.futures import ThreadPoolExecutor
+
+    import face_processor
+
+    face_processor.configure_detectors(threads, opencv_threads)
+    photos = [make_gray_photo(width, height, seed=index) for index in range(count)]
+
+    # Load the model once outside the timing, like a warmed up server
+    face_processor.detect_faces(photos[0])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(face_processor.detect_faces, photos))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "threads": threads,
+        "opencv_threads": face_processor.opencv_threads(threads, opencv_threads),
+        "photos_per_sec": count / elapsed,
+        "detectors": face_processor.get_detector_pool().loaded,
+    }
+
+
+# Detection throughput as concurrent requests grow, with OpenCV's threads tuned
+# to the concurrency and with OpenCV left to its defaults
+def bench_scaling(threads: list[int], count: int, width: int, height: int):
+    modes = [("tuned", 0), ("opencv default", -1)]
+
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for mode, opencv_threads in modes:
+            baseline = None
+            for thread_count in threads:
+                result = pool.apply(
+                    _scaling_run,
+                    (thread_count, opencv_threads, count, width, height),
+                )
+                baseline = baseline or result["photos_per_sec"] / thread_count
+                speedup = result["photos_per_sec"] / baseline
+                print(
+                    f"{mode:<14} | {thread_count:>3} thread(s) | "
+                    + (
+                        f"OpenCV {result['opencv_threads']:>3} | "
+                        if opencv_threads >= 0
+                        else "OpenCV   - | "
+                    )
+                    + f"{result['photos_per_sec']:7.1f} photos/s | "
+                    f"speedup {speedup:5.2f}x | "
+                    f"efficiency {speedup / thread_count:5.0%} | "
+                    f"{result['detectors']} detector(s)"
+                )
+
+
+# Percentiles reported for every pipeline stage
+PERCENTILES = (50, 90, 99)
+
+# Stages of the card pipeline, in the order they run
+PIPELINE_STAGES = (
+    "decode",
+    "hash",
+    "detect",
+    "crop",
+    "composite",
+    "text",
+    "encode",
+    "compress",
+    "render_pdf",
+)
+
+# Relative slowdown of a stage before a comparison calls it a regression
+REGRESSION_TOLERANCE = 0.2
+
+
+class StageTimer:
+    """Collects wall-clock samples per named stage."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        yield
+        self.samples[stage].append(time.perf_counter() - start)
+
+    # Latency percentiles in milliseconds for every stage that ran
+    def summary(self) -> dict[str, dict[str, float]]:
+        return {
+            stage: {
+                f"p{q}_ms": float(np.percentile(self.samples[stage], q)) * 1000
+                for q in PERCENTILES
+            }
+            | {"count": len(self.samples[stage])}
+            for stage in PIPELINE_STAGES
+            if self.samples[stage]
+        }
+
+
+# Write count synthetic member photos and a matching roster into directory
+def make_roster(
+    directory: str, count: int, width: int, height: int, photo: str | None = None
+) -> list[dict]:
+    roster = []
+    for index in range(count):
+        if photo:
+            gray = load_gray_photo(photo, width, height)
+        else:
+            gray = make_gray_photo(width, height, seed=index)
+
+        photo_path = os.path.join(directory, f"photo_{index}.jpg")
+        Image.fromarray(gray).convert("RGB").save(photo_path, quality=90)
+
+        roster.append(
+            {
+                "name": f"Member Number{index}",
+                "phone": f"98765{index:05d}",
+                "post": "Member",
+                "photo": photo_path,
+            }
+        )
+
+    return roster
+
+
+# Run every stage of the pipeline over a synthetic roster in a fresh process,
+# with all outputs kept in a temporary directory
+def _pipeline_run(
+    width: int, height: int, count: int, repeats: int, photo: str | None
+) -> dict:
+    import constants as c
+
+    work_dir = tempfile.mkdtemp(prefix="id-card-bench-")
+    c.IMAGES_DIR = os.path.join(work_dir, "outputs/")
+    c.COMPRESSED_DIR = os.path.join(work_dir, "compressed/")
+    os.makedirs(c.IMAGES_DIR)
+    os.makedirs(c.COMPRESSED_DIR)
+
+    import card_store
+    import face_processor
+    import id_creator
+    import layout
+    import pdf_gen
+
+    try:
+        roster = make_roster(work_dir, count, width, height, photo)
+        plan = layout.get_layout_plan()
+        timer = StageTimer()
+
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+
+        for _ in range(repeats):
+            for row in roster:
+                with timer.time("decode"):
+                    image = Image.open(row["photo"])
+                    image.load()
+
+                with timer.time("hash"):
+                    face_processor.calculate_image_hash(row["photo"])
+
+                with timer.time("detect"):
+                    faces = face_processor.detect_faces(np.asarray(image.convert("L")))
+
+                # Synthetic photos have no faces, those use the whole photo
+                with timer.time("crop"):
+                    if len(faces):
+                        x, y, w, h = faces[0]
+                        image = image.crop((x, y, x + w, y + h))
+                    face = face_processor.crop_to_square(image.convert("RGB"))
+
+                with timer.time("composite"):
+                    card = plan.composite(face)
+
+                with timer.time("text"):
+                    plan.draw_text(
+                        card,
+                        {
+                            "name": row["name"],
+                            "phone": row["phone"],
+                            "post": row["post"],
+                        },
+                    )
+
+                filename = (
+                    f"ID_Card_{row['name'].replace(' ', '_')}_"
+                    f"{row['phone']}_{row['post']}.{c.IMAGE_EXTENSION}"
+                )
+                with timer.time("encode"):
+                    card_path = card_store.get_card_store().save(
+                        filename, id_creator.encode_card(card)
+                    )
+
+                with timer.time("compress"):
+                    pdf_gen.compress_image(card_path)
+
+            with timer.time("render_pdf"):
+                pdf_gen.render_pdf(os.path.join(work_dir, "output.pdf"))
+
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "size": f"{width}x{height}",
+        "count": count,
+        "cards_per_sec": count * repeats / elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_delta_mb": peak_rss_mb() - rss_before,
+        "stages": timer.summary(),
+    }
+
+
+# Time the whole pipeline for each photo size and roster size
+def bench_pipeline(
+    sizes: list[tuple[int, int]], counts: list[int], repeats: int, photo: str | None
+) -> list[dict]:
+    results = []
+
+    # A spawned process per run keeps memory peaks independent of each other
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for width, height in sizes:
+            for count in counts:
+                result = pool.apply(
+                    _pipeline_run, (width, height, count, repeats, photo)
+                )
+                results.append(result)
+
+                print(
+                    f"{result['size']:>11} x {count:<4} | "
+                    f"{result['cards_per_sec']:6.2f} cards/s | "
+                    f"peak RSS {result['peak_rss_mb']:7.1f} MB "
+                    f"(+{result['peak_rss_delta_mb']:.1f})"
+                )
+                for stage, stats in result["stages"].items():
+                    percentiles = " ".join(
+                        f"p{q} {stats[f'p{q}_ms']:8.1f} ms" for q in PERCENTILES
+                    )
+                    print(f"{'':>14}{stage:<11} | {percentiles}")
+
+    return results
+
+
+def _result_key(result: dict) -> str:
+    return f"{result['size']} x {result['count']}"
+
+
+# Compare results against a saved baseline, returning the regressions found
+def compare_baseline(
+    results: list[dict], baseline: list[dict], tolerance: float
+) -> list[str]:
+    baseline = {_result_key(result): result for result in baseline}
+    regressions = []
+
+    for result in results:
+        key = _result_key(result)
+        if key not in baseline:
+            continue
+        old = baseline[key]
+
+        if result["cards_per_sec"] < old["cards_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{key}: {old['cards_per_sec']:.2f} -> "
+                f"{result['cards_per_sec']:.2f} cards/s"
+            )
+
+        for stage, stats in result["stages"].items():
+            old_stats = old["stages"].get(stage)
+            if old_stats and stats["p50_ms"] > old_stats["p50_ms"] * (1 + tolerance):
+                regressions.append(
+                    f"{key} {stage}: p50 {old_stats['p50_ms']:.1f} -> "
+                    f"{stats['p50_ms']:.1f} ms"
+                )
+
+    return regressions
+
+
+# Heavy dependencies that command line tools should only load when they need them
+HEAVY_MODULES = ("cv2", "fpdf", "gradio")
+
+# Modules and command line tools whose startup is measured
+IMPORT_TARGETS = ("constants", "pdf_gen", "batch", "id_creator", "face_processor")
+CLI_TARGETS = ("pdf_gen.py", "batch.py", "card_index.py")
+
+
+# Wall-clock seconds of running a fresh interpreter with these arguments
+def _time_python(args: list[str]) -> tuple[float, str]:
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, *args],
+        cwd=project_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return time.perf_counter() - start, completed.stdout
+
+
+# Time importing each module and starting each tool in a fresh interpreter
+def bench_imports(repeats: int, modules: list[str], tools: list[str]):
+    for module in modules:
+        code = (
+            f"import sys, {module}; "
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+        )
+        runs = [_time_python(["-c", code]) for _ in range(repeats)]
+        heavy = runs[-1][1].strip() or "none"
+        print(
+            f"import {module:<16} | "
+            f"median {statistics.median(t for t, _ in runs) * 1000:7.1f} ms | "
+            f"min {min(t for t, _ in runs) * 1000:7.1f} ms | heavy: {heavy}"
+        )
+
+    for tool in tools:
+        runs = [_time_python([tool, "--help"])[0] for _ in range(repeats)]
+        print(
+            f"{tool + ' --help':<23} | "
+            f"median {statistics.median(runs) * 1000:7.1f} ms | "
+            f"min {min(runs) * 1000:7.1f} ms"
+        )
+
+
+# Save one rendered card with every output profile, and time what render_pdf then
+# has to do with each file before it can be embedded
+def bench_encoding(repeats: int, photo: str | None):
+    import constants as c
+    import id_creator
+    import layout
+    import pdf_gen
+
+    if photo:
+        gray = load_gray_photo(photo, 1200, 1200)
+    else:
+        gray = make_gray_photo(1200, 1200)
+
+    card = layout.get_layout_plan().render(
+        Image.fromarray(gray).convert("RGB"),
+        {"name": "Member Number", "phone": "98765 43210", "post": "Member"},
+    )
+
+    with tempfile.TemporaryDirectory(prefix="id-card-bench-") as work_dir:
+        for profile, settings in c.OUTPUT_PROFILES.items():
+            path = os.path.join(work_dir, f"{profile}.{settings['extension']}")
+
+            encode_times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                id_creator.save_card(card, path, profile)
+                encode_times.append(time.perf_counter() - start)
+
+            # In memory so every repeat pays for the work, not the compressed cache
+            prepare_times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                pdf_gen.prepare_image(path, in_memory=True)
+                prepare_times.append(time.perf_counter() - start)
+
+            print(
+                f"{profile:<11} | "
+                f"encode {statistics.median(encode_times) * 1000:7.1f} ms | "
+                f"{os.path.getsize(path) / 1024:8.1f} KB | "
+                f"PDF prep {statistics.median(prepare_times) * 1000:7.1f} ms"
+            )
+
+
+# Seconds Ghostscript takes to rasterize a PDF at dpi, as a stand-in for a print
+# shop's RIP spooling it, or None when Ghostscript is not installed
+def spool_seconds(pdf_path: str, dpi: int) -> float | None:
+    gs = shutil.which("gs")
+    if gs is None:
+        return None
+
+    start = time.perf_counter()
+    subprocess.run(
+        [gs, "-q", "-dNOPAUSE", "-dBATCH", "-sDEVICE=nullpage", f"-r{dpi}", pdf_path],
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+# Print the same cards with each PDF backend and compare build time, file size
+# and the time to rasterize the result for printing
+def bench_pdf_backends(count: int, copies: int, repeats: int, photo: str | None):
+    import constants as c
+
+    with tempfile.TemporaryDirectory(prefix="id-card-bench-") as work_dir:
+        c.IMAGES_DIR = os.path.join(work_dir, "outputs/")
+        c.COMPRESSED_DIR = os.path.join(work_dir, "compressed/")
+        os.makedirs(c.IMAGES_DIR)
+        os.makedirs(c.COMPRESSED_DIR)
+
+        import card_store
+        import id_creator
+        import layout
+        import pdf_gen
+
+        plan = layout.get_layout_plan()
+        for row in make_roster(work_dir, count, 1200, 1200, photo):
+            card = plan.render(
+                Image.open(row["photo"]).convert("RGB"),
+                {"name": row["name"], "phone": row["phone"], "post": row["post"]},
+            )
+            card_store.get_card_store().save(
+                f"{row['phone']}.{c.IMAGE_EXTENSION}", id_creator.encode_card(card)
+            )
+
+        for backend in pdf_gen.PDF_BACKENDS:
+            output = os.path.join(work_dir, f"{backend}.pdf")
+
+            # Fresh compressed images each time, so the cards backend is not cached
+            build_times = []
+            for _ in range(repeats):
+                shutil.rmtree(c.COMPRESSED_DIR)
+                os.makedirs(c.COMPRESSED_DIR)
+                start = time.perf_counter()
+                pdf_gen.render_pdf(output, copies=copies, backend=backend)
+                build_times.append(time.perf_counter() - start)
+
+            spool = spool_seconds(output, c.PRINT_DPI)
+            print(
+                f"{backend:<6} | "
+                f"build {statistics.median(build_times):7.2f} s | "
+                f"{os.path.getsize(output) / (1024 * 1024):8.1f} MB | "
+                "spool "
+                + (f"{spool:7.2f} s" if spool is not None else "n/a (needs gs)")
+            )
+
+
+def parse_size(value: str) -> tuple[int, int]:
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ID card maker benchmarks")
+    subparsers = parser.add_subparsers(dest="suite", required=True)
+
+    detection = subparsers.add_parser(
+        "detection", help="Face detection latency and memory"
+    )
+    detection.add_argument(
+        "--sizes",
+        nargs="+",
+        type=parse_size,
+        default=[(1600, 1200), (3000, 4000), (4284, 5712)],
+        help="Photo sizes as WIDTHxHEIGHT",
+    )
+    detection.add_argument("--repeats", type=int, default=3)
+    detection.add_argument("--photo", help="Use a real photo instead of synthetic data")
+    detection.add_argument("--max-side", type=int, default=1024)
+
+    scaling = subparsers.add_parser(
+        "scaling", help="Face detection throughput as concurrent requests grow"
+    )
+    scaling.add_argument(
+        "--threads",
+        nargs="+",
+        type=int,
+        default=sorted({1, 2, 4, os.cpu_count() or 1}),
+        help="Concurrent detections to measure",
+    )
+    scaling.add_argument("--count", type=int, default=32, help="Photos per run")
+    scaling.add_argument(
+        "--size", type=parse_size, default=(1600, 1200), help="Photo size"
+    )
+
+    pipeline = subparsers.add_parser(
+        "pipeline", help="Per-stage latency, memory and throughput of card making"
+    )
+    pipeline.add_argument(
+        "--sizes",
+        nargs="+",
+        type=parse_size,
+        default=[(1200, 1600), (3000, 4000)],
+        help="Photo sizes as WIDTHxHEIGHT",
+    )
+    pipeline.add_argument(
+        "--counts", nargs="+", type=int, default=[10], help="Roster sizes"
+    )
+    pipeline.add_argument("--repeats", type=int, default=1)
+    pipeline.add_argument("--photo", help="Use a real photo instead of synthetic data")
+    pipeline.add_argument("--save", help="Write the results to a JSON baseline")
+    pipeline.add_argument(
+        "--compare", help="Compare against a JSON baseline, exit 1 on regressions"
+    )
+    pipeline.add_argument(
+        "--tolerance",
+        type=float,
+        default=REGRESSION_TOLERANCE,
+        help="Allowed relative slowdown before a regression is reported",
+    )
+
+    imports = subparsers.add_parser(
+        "imports", help="Startup time of modules and command line tools"
+    )
+    imports.add_argument("--repeats", type=int, default=5)
+    imports.add_argument("--modules", nargs="+", default=list(IMPORT_TARGETS))
+    imports.add_argument("--tools", nargs="+", default=list(CLI_TARGETS))
+
+    encode = subparsers.add_parser(
+        "encode", help="Save time and file size of each output profile"
+    )
+    encode.add_argument("--repeats", type=int, default=5)
+    encode.add_argument("--photo", help="Use a real photo instead of synthetic data")
+
+    backends = subparsers.add_parser(
+        "pdf-backends",
+        help="Build time, file size and spool time of each PDF backend",
+    )
+    backends.add_argument("--count", type=int, default=20, help="Distinct cards")
+    backends.add_argument("--copies", type=int, default=1, help="Copies of each card")
+    backends.add_argument("--repeats", type=int, default=3)
+    backends.add_argument("--photo", help="Use a real photo instead of synthetic data")
+
+    args = parser.parse_args()
+
+    if args.suite == "detection":
+        # Worker processes run from the project directory
+        photo = os.path.abspath(args.photo) if args.photo else None
+        bench_detection(args.sizes, args.repeats, photo, args.max_side)
+
+    elif args.suite == "scaling":
+        bench_scaling(args.threads, args.count, *args.size)
+
+    elif args.suite == "pipeline":
+        photo = os.path.abspath(args.photo) if args.photo else None
+
+        # Read the baseline first, it may be the same file as --save
+        baseline = None
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                baseline = json.load(f)
+
+        results = bench_pipeline(args.sizes, args.counts, args.repeats, photo)
+
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+
+        if baseline is not None:
+            regressions = compare_baseline(results, baseline, args.tolerance)
+            for regression in regressions:
+                print(f"Regression: {regression}")
+            if regressions:
+                sys.exit(1)
+            print("No regressions against the baseline.")
+
+    elif args.suite == "imports":
+        bench_imports(args.repeats, args.modules, args.tools)
+
+    elif args.suite == "encode":
+        bench_encoding(
+            args.repeats, os.path.abspath(args.photo) if args.photo else None
+        )
+
+    elif args.suite == "pdf-backends":
+        bench_pdf_backends(
+            args.count,
+            args.copies,
+            args.repeats,
+            os.path.abspath(args.photo) if args.photo else None,
+        )
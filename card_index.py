@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import card_store
+import constants as c
+import layout
+
+# Columns shown in the ID card list, in order
+LIST_COLUMNS = ("id", "name", "phone", "post", "filename")
+
+
+# Extract name, phone, post and template tag from an output filename
+# like ID_Card_First_Middle_Last_phone_Post.png or ..._Post@tag.png,
+# the tag being "" for the default template
+def parse_card_filename(filename: str) -> tuple[str, str, str, str] | None:
+    stem = os.path.splitext(filename)[0]
+    if not stem.startswith("ID_Card_"):
+        return None
+
+    stem, _, tag = stem.partition("@")
+    parts = stem.replace("ID_Card_", "", 1).split("_")
+
+    # The phone number follows a two or three word name
+    for phone_idx in (2, 3):
+        phone = parts[phone_idx] if len(parts) > phone_idx else ""
+        if len(phone) == 10 and phone.isdigit():
+            name = " ".join(parts[:phone_idx])
+            post = " ".join(parts[phone_idx + 1 :])
+            return name, phone, post, tag
+
+    return None
+
+
+class CardIndex:
+    """Persistent index of generated ID cards and their details."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+        # Created on first use, so importing this module touches no files
+        self._ready = False
+        self._ready_lock = threading.Lock()
+
+    def _create_schema(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        with conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cards ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " filename TEXT NOT NULL UNIQUE,"
+                " name TEXT NOT NULL,"
+                " phone TEXT NOT NULL,"
+                " post TEXT NOT NULL,"
+                " output_path TEXT NOT NULL,"
+                " photo_box TEXT,"
+                " fingerprint TEXT,"
+                " face_key TEXT,"
+                " template TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+
+            # Indexes created before these columns existed
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(cards)")]
+            for column in ("fingerprint", "face_key", "template"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE cards ADD COLUMN {column} TEXT")
+
+    # A new connection per operation keeps the index safe to use from any thread
+    def _connect(self) -> sqlite3.Connection:
+        if not self._ready:
+            with self._ready_lock:
+                if not self._ready:
+                    self._create_schema()
+                    self._ready = True
+
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # Add a card or update the details of an existing one, returning its id
+    def upsert(
+        self,
+        output_path: str,
+        name: str,
+        phone: str,
+        post: str,
+        photo_box: tuple[int, int, int, int] | None = None,
+        fingerprint: str | None = None,
+        face_key: str | None = None,
+        template: str | None = None,
+    ) -> int:
+        now = time.time()
+        filename = os.path.basename(output_path)
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO cards"
+                " (filename, name, phone, post, output_path, photo_box, fingerprint,"
+                " face_key, template, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (filename) DO UPDATE SET"
+                " name = excluded.name, phone = excluded.phone, post = excluded.post,"
+                " output_path = excluded.output_path, photo_box = excluded.photo_box,"
+                " fingerprint = excluded.fingerprint, face_key = excluded.face_key,"
+                " template = excluded.template, updated_at = excluded.updated_at",
+                (
+                    filename,
+                    name,
+                    phone,
+                    post,
+                    output_path,
+                    json.dumps(photo_box) if photo_box else None,
+                    fingerprint,
+                    face_key,
+                    template,
+                    now,
+                    now,
+                ),
+            )
+            row = conn.execute(
+                "SELECT id FROM cards WHERE filename = ?", (filename,)
+            ).fetchone()
+
+        return row["id"]
+
+    # Remove a card from the index
+    def remove(self, card_id: int) -> bool:
+        with self._connect() as conn:
+            return (
+                conn.execute("DELETE FROM cards WHERE id = ?", (card_id,)).rowcount > 0
+            )
+
+    # Forget a card by its filename, for when its file is replaced under a new name
+    def remove_filename(self, filename: str) -> bool:
+        with self._connect() as conn:
+            deleted = conn.execute("DELETE FROM cards WHERE filename = ?", (filename,))
+            return deleted.rowcount > 0
+
+    # Record where cards were moved to, given {filename: new output path}
+    def update_output_paths(self, output_paths: dict[str, str]):
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE cards SET output_path = ? WHERE filename = ?",
+                [(path, filename) for filename, path in output_paths.items()],
+            )
+
+    # Get every detail recorded for a card
+    def get(self, card_id: int) -> dict | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM cards WHERE id = ?", (card_id,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return self._to_card(row)
+
+    def _to_card(self, row: sqlite3.Row) -> dict:
+        card = dict(row)
+        if card["photo_box"]:
+            card["photo_box"] = tuple(json.loads(card["photo_box"]))
+        return card
+
+    def _where(self, query: str) -> tuple[str, tuple]:
+        if not query.strip():
+            return "", ()
+
+        pattern = f"%{query.strip()}%"
+        return (
+            " WHERE name LIKE ? OR phone LIKE ? OR post LIKE ? OR filename LIKE ?",
+            (pattern,) * 4,
+        )
+
+    # Number of cards matching the search query
+    def count(self, query: str = "") -> int:
+        where, params = self._where(query)
+        with self._connect() as conn:
+            return conn.execute(
+                f"SELECT COUNT(*) FROM cards{where}", params
+            ).fetchone()[0]
+
+    # One page of cards matching the search query, as list rows
+    def search(
+        self, query: str = "", offset: int = 0, limit: int = -1
+    ) -> list[list[int | str]]:
+        where, params = self._where(query)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(LIST_COLUMNS)} FROM cards{where}"
+                " ORDER BY filename LIMIT ? OFFSET ?",
+                (*params, limit, offset),
+            ).fetchall()
+
+        return [list(row) for row in rows]
+
+    # Every card with all its details
+    def cards(self) -> list[dict]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM cards ORDER BY filename").fetchall()
+
+        return [self._to_card(row) for row in rows]
+
+    # Sync the index with the cards found in a card store, keeping
+    # what is already recorded for cards that are still there
+    def rebuild_from_disk(self, store: card_store.FlatStore) -> tuple[int, list[str]]:
+        # Templates by the tag their cards' filenames carry, with their photo box
+        templates = {}
+        for template in layout.available_templates():
+            try:
+                photo_box = layout.get_layout_plan(template).photo_box
+            except (OSError, ValueError):
+                continue
+            templates[layout.template_tag(template)] = (template, json.dumps(photo_box))
+
+        cards, skipped = [], []
+        for filename in store.filenames():
+            details = parse_card_filename(filename)
+            if details is None:
+                skipped.append(filename)
+                continue
+
+            *details, tag = details
+            template, photo_box = templates.get(tag, (None, None))
+            output_path = store.path(filename)
+            modified = os.path.getmtime(output_path)
+            cards.append(
+                (
+                    filename,
+                    *details,
+                    output_path,
+                    photo_box,
+                    template,
+                    modified,
+                    modified,
+                )
+            )
+
+        with self._connect() as conn:
+            on_disk = {card[0] for card in cards}
+            indexed = [row[0] for row in conn.execute("SELECT filename FROM cards")]
+            conn.executemany(
+                "DELETE FROM cards WHERE filename = ?",
+                [(filename,) for filename in indexed if filename not in on_disk],
+            )
+            conn.executemany(
+                "INSERT INTO cards"
+                " (filename, name, phone, post, output_path, photo_box, template,"
+                " created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (filename) DO NOTHING",
+                cards,
+            )
+
+        return len(cards), skipped
+
+    def __len__(self) -> int:
+        return self.count()
+
+
+# Index shared by the card generator and the app
+index = CardIndex(c.CARD_INDEX_DB)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generated ID card index")
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help=f"Rebuild the index from the cards in {c.IMAGES_DIR}",
+    )
+    args = parser.parse_args()
+
+    if args.rebuild:
+        indexed, skipped = index.rebuild_from_disk(card_store.get_card_store())
+        for filename in skipped:
+            print(f"Skipped {filename}: not an ID card filename")
+        print(f"Indexed {indexed} card(s).")
+    else:
+        print(f"{len(index)} card(s) indexed in {c.CARD_INDEX_DB}.")
@@ -0,0 +1,196 @@
+import argparse
+import errno
+import functools
+import hashlib
+import os
+import shutil
+import threading
+from typing import BinaryIO, Callable
+
+import constants as c
+
+
+# Write a file through a temporary file next to it, so readers never see it half
+# written and an interrupted write leaves nothing behind. data is the file's
+# bytes, or a function writing them to the open file, e.g. a PIL image's save
+def write_atomic(path: str, data: bytes | Callable[[BinaryIO], None]):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            if callable(data):
+                data(f)
+            else:
+                f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# Move a file, renaming it when source and target share a filesystem. Across
+# filesystems it is copied and synced first, so the target is never partial
+def move_file(source: str, target: str):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.replace(source, target)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    # Synced before the rename, so a crash never leaves the only copy partial
+    def copy(f: BinaryIO):
+        with open(source, "rb") as src:
+            shutil.copyfileobj(src, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    write_atomic(target, copy)
+    shutil.copystat(source, target)
+    os.remove(source)
+
+
+# Stop a card name from reaching outside its directory, e.g. with a / in the details
+def check_filename(filename: str) -> str:
+    if os.path.basename(filename) != filename or filename in ("", ".", ".."):
+        raise ValueError(f"Not a plain card filename: {filename!r}")
+    return filename
+
+
+# Whether a directory entry is a stored card, not a temporary file mid-write
+def _is_card(entry: os.DirEntry) -> bool:
+    return entry.is_file() and not entry.name.endswith(".tmp")
+
+
+class FlatStore:
+    """Every card file directly in one directory."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.root, check_filename(filename))
+
+    # Store a card's encoded bytes atomically and return its path
+    def save(self, filename: str, data: bytes) -> str:
+        path = self.path(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, data)
+        return path
+
+    def exists(self, filename: str) -> bool:
+        return os.path.exists(self.path(filename))
+
+    def delete(self, filename: str) -> bool:
+        try:
+            os.remove(self.path(filename))
+        except FileNotFoundError:
+            return False
+        return True
+
+    # Filenames of every stored card, sorted
+    def filenames(self) -> list[str]:
+        if not os.path.isdir(self.root):
+            return []
+        with os.scandir(self.root) as entries:
+            return sorted(entry.name for entry in entries if _is_card(entry))
+
+
+class ShardedStore(FlatStore):
+    """Card files spread over subdirectories named by a hash of the card's name,
+    so no directory grows past a few hundred files."""
+
+    def __init__(self, root: str, shard_chars: int = c.CARD_STORE_SHARD_CHARS):
+        super().__init__(root)
+        self.shard_chars = shard_chars
+
+    # Shard of a card, from its name without the extension so every
+    # format of the same card lands in the same directory
+    def shard(self, filename: str) -> str:
+        stem = os.path.splitext(filename)[0]
+        return hashlib.sha1(stem.encode()).hexdigest()[: self.shard_chars]
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.root, self.shard(filename), check_filename(filename))
+
+    def filenames(self) -> list[str]:
+        if not os.path.isdir(self.root):
+            return []
+
+        filenames = []
+        with os.scandir(self.root) as shards:
+            for shard in shards:
+                if not shard.is_dir() or len(shard.name) != self.shard_chars:
+                    continue
+                with os.scandir(shard.path) as entries:
+                    filenames += [entry.name for entry in entries if _is_card(entry)]
+
+        return sorted(filenames)
+
+
+# Create a card store for the configured backend
+def create_store(backend: str, root: str) -> FlatStore | ShardedStore:
+    if backend == "flat":
+        return FlatStore(root)
+    elif backend == "sharded":
+        return ShardedStore(root)
+
+    raise ValueError(f"Unknown card store backend: {backend!r}")
+
+
+# Store used for generated cards, created on first use
+@functools.cache
+def get_card_store() -> FlatStore | ShardedStore:
+    return create_store(c.CARD_STORE_BACKEND, c.IMAGES_DIR)
+
+
+# Move cards from a flat directory into a store, returning {filename: new path}.
+# Files already where the store keeps them are left alone
+def migrate(source_dir: str, store: FlatStore | ShardedStore) -> dict[str, str]:
+    moved = {}
+    with os.scandir(source_dir) as entries:
+        files = sorted(
+            entry.name
+            for entry in entries
+            if _is_card(entry) and entry.name.endswith(c.OUTPUT_EXTENSIONS)
+        )
+
+    for filename in files:
+        source = os.path.join(source_dir, filename)
+        target = store.path(filename)
+        if os.path.abspath(source) == os.path.abspath(target):
+            continue
+
+        move_file(source, target)
+        moved[filename] = target
+
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generated ID card storage")
+    parser.add_argument(
+        "--migrate",
+        nargs="?",
+        const=c.IMAGES_DIR,
+        metavar="DIR",
+        help="Move cards from a flat directory into the "
+        f"{c.CARD_STORE_BACKEND} store (default: {c.IMAGES_DIR})",
+    )
+    args = parser.parse_args()
+
+    store = get_card_store()
+    if args.migrate:
+        import card_index
+
+        moved = migrate(args.migrate, store)
+        card_index.index.update_output_paths(moved)
+        print(f"Moved {len(moved)} card(s) into {store.root}")
+
+        # Index moved cards the index didn't know about yet
+        if moved:
+            indexed, _ = card_index.index.rebuild_from_disk(store)
+            print(f"Indexed {indexed} card(s).")
+    else:
+        print(f"{len(store.filenames())} card(s) in {store.root}")
@@ -1,54 +1,133 @@
+import functools
 import os
 
+# Every path below is inside the project directory, wherever the tools are run from
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 #* Constants for template
 
 PICTURE_POSITION = (525, 790)  # Top-left corner of the picture
 PICTURE_SIZE = (440, 440)  # Width and height of the picture in pixels
 
-TEMPLATE_PATH = "example-template-id-card.png"  # Path to the template file
+TEMPLATE_PATH = os.path.join(BASE_DIR, "example-template-id-card.png")  # Path to the template file
 TEXT_POSITION = (220, 1265)  # Top-left starting position of text
 #! TEXT_POSITION[0] is overridden if the text cant be fitted in the template
 FONT_SIZE = 72  # Font size for text
-FONT_PATH = "example-Exo-ExtraBold.otf"  # Path to the font file
+FONT_PATH = os.path.join(BASE_DIR, "example-Exo-ExtraBold.otf")  # Path to the font file
 
 TEXT_HEADINGS = ["Name", "Mobile", "Post"]  # Headings text
 PADDING_HEADING = 25  # Padding between heading block
 PADDING_INPUT = 45  # Padding between colon block and input (details) block
-
-IMAGES_OUTPUT_PATH = "outputs/"
+TEMPLATES_DIR = os.path.join(BASE_DIR, "templates/")  # Extra card designs as JSON/TOML template specs
+STATIC_LAYER_CACHE_SIZE = 32  # Pre-rendered heading/colon layers kept, one per text position
+
+IMAGES_OUTPUT_PATH = os.path.join(BASE_DIR, "outputs/")
+CARD_STORE_BACKEND = "sharded"  # "flat" keeps cards directly in IMAGES_OUTPUT_PATH, "sharded" spreads them over hashed subdirectories
+CARD_STORE_SHARD_CHARS = 2  # Hex characters naming each shard directory (2 = 256 shards)
+FACES_DIR = os.path.join(BASE_DIR, "faces/")  # Cropped face photos at native resolution, keyed by content
+FACE_STORE_COMPRESS_LEVEL = 1  # PNG compression for stored faces (0-9, lower is faster)
+CARD_INDEX_DB = os.path.join(BASE_DIR, "cards.sqlite3")  # Index of generated cards and their details
+LIST_PAGE_SIZE = 50  # Cards shown per page in the ID card list
+THUMBNAILS_DIR = os.path.join(BASE_DIR, "thumbnails/")  # Small previews of cards for the list gallery
+THUMBNAIL_SIZE = (150, 200)  # Maximum width and height of a card preview
+THUMBNAIL_QUALITY = 80  # JPEG quality of card previews
+
+
+#* Constants for output encoding
+
+PRINT_DPI = 300  # Resolution of print-ready JPEGs
+PRINT_QUALITY = 90  # JPEG quality of print-ready images
+
+# How generated cards are saved: Pillow format, file extension and save options
+OUTPUT_PROFILES = {
+    "png": {"format": "PNG", "extension": "png", "options": {}},  # Pillow defaults
+    "png-fast": {  # Larger files, several times faster to save
+        "format": "PNG",
+        "extension": "png",
+        "options": {"compress_level": 1, "optimize": False},
+    },
+    "webp": {  # Lossless at the lowest effort, smaller and faster to save than PNG
+        "format": "WEBP",
+        "extension": "webp",
+        "options": {"lossless": True, "quality": 0, "method": 0},
+    },
+    "jpeg-print": {  # Print-ready, embedded in PDFs without re-encoding
+        "format": "JPEG",
+        "extension": "jpg",
+        "options": {"quality": PRINT_QUALITY, "dpi": (PRINT_DPI, PRINT_DPI)},
+    },
+}
+OUTPUT_PROFILE = "png"  # Profile used for new cards, one of OUTPUT_PROFILES
+OUTPUT_EXTENSIONS = tuple(
+    sorted({f".{profile['extension']}" for profile in OUTPUT_PROFILES.values()})
+)  # Extensions of cards saved with any profile
 
 
 #* Constants for PDF generation
 
 IMAGE_RATIO = (3.75, 5)  # Width and height of the image in UNIT
-IMAGE_EXTENSION = os.path.splitext(TEMPLATE_PATH)[1][1:]  # Extension of the original output image files
+IMAGE_EXTENSION = OUTPUT_PROFILES[OUTPUT_PROFILE]["extension"]  # Extension of the original output image files
 
 SHEET_RATIO = (12, 18)  # Width and height of the sheet in UNIT
-
-IMAGE_FREQUENCY = (
-    int(SHEET_RATIO[0] / IMAGE_RATIO[0]),
-    int(SHEET_RATIO[1] / IMAGE_RATIO[1]),
-)  # Number of images in each row and column
+#! Cards per row and column and the equal spacing between them are worked out for each sheet size by imposition.SheetLayout
 
 UNIT = "in"
 
-IMAGE_SPACING = (
-    (SHEET_RATIO[0] - IMAGE_FREQUENCY[0] * IMAGE_RATIO[0])
-    / (IMAGE_FREQUENCY[0] + 1),
-    (SHEET_RATIO[1] - IMAGE_FREQUENCY[1] * IMAGE_RATIO[1])
-    / (IMAGE_FREQUENCY[1] + 1),
-)  # Spacing between images keeping it equal everywhere
+SHEET_SIZES = [SHEET_RATIO]  # Sheet sizes used in order when printing, the last one repeats
+PRINT_COPIES = 1  # Copies of each card printed by default
 
 IMAGES_DIR = IMAGES_OUTPUT_PATH
-OUTPUT_PDF = "output.pdf"
+OUTPUT_PDF = os.path.join(BASE_DIR, "output.pdf")
+PDF_CHUNK_PAGES = 0  # Sheets per PDF when pdf_gen.py prints in resumable chunks, 0 writes a single PDF (the app always writes one)
+
+COMPRESSED_DIR = os.path.join(BASE_DIR, "compressed/")
+PRINTS_DIR = os.path.join(BASE_DIR, "prints/")  # PDFs printed from the app, kept for download
+PRINTS_KEEP = 20  # Printed PDFs kept, the oldest are removed first
+PRINTS_MAX_AGE_SECONDS = 3600  # Printed PDFs older than this are removed
+JOB_CONCURRENCY = 1  # Background jobs (regenerate, print) running at once, others queue
+JOB_WORKERS = max(1, (os.cpu_count() or 1) - 1)  # Threads per job, leaving a core for interactive requests
+COMPRESS_WORKERS = JOB_WORKERS  # Threads compressing images for the PDF
+PDF_BACKEND = "cards"  # "cards" embeds every card in the PDF, "sheets" embeds one pre-composited image per sheet
+SHEET_RASTER_WORKERS = JOB_WORKERS  # Processes compositing sheets for the "sheets" backend
+SHEET_RASTER_CARD_CACHE = 64  # Resized cards each of those processes keeps for reuse
+
+
+#* Constants for face detection cache
+
+CACHE_DIR = os.path.join(BASE_DIR, "cache/")
+
+FACE_CACHE_BACKEND = "tiered"  # "memory", "disk" or "tiered" (memory in front of disk)
+FACE_CACHE_MAX_ENTRIES = 256  # Number of photos kept in the in-memory LRU
+FACE_CACHE_DB = CACHE_DIR + "faces.sqlite3"  # On-disk store keyed by content hash
+FACE_CACHE_DISK_MAX_ENTRIES = 20000  # Number of photos kept on disk
+
+
+#* Constants for face detection
+
+DETECTION_MAX_SIDE = 1024  # Longest side of the copy used for detection (0 = full resolution)
+DETECTION_REFINE = True  # Re-detect around each face at higher resolution
+DETECTION_REFINE_PADDING = 0.5  # Padding around a face for refinement, relative to its size
+DETECTOR_POOL_SIZE = JOB_WORKERS  # Face detectors, one per concurrent detection; further requests wait for a free one
+OPENCV_THREADS = 0  # Threads OpenCV uses inside one detection (0 = cores / DETECTOR_POOL_SIZE, -1 = OpenCV's default)
+
+
+
+#* Constants for request coalescing
+
+COALESCE_TTL_SECONDS = 5.0  # Identical generate or print requests this soon after one finishes get its result
+COALESCE_MAX_RESULTS = 64  # Recent results kept for those repeats
 
-COMPRESSED_DIR = "compressed/"
 
+#* Constants for metrics
 
-# Set working directory to the script's directory
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
+METRICS_ENABLED = True  # Record per-stage timings (hooks are no-ops when off)
+METRICS_PORT = 0  # Serve Prometheus metrics on localhost at this port (0 = off)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Latency histogram bounds in seconds
+SLOW_REQUEST_SECONDS = 2.0  # Requests slower than this are logged with their stage breakdown
 
-# Create directories if they don't exist
-for path in [IMAGES_DIR, COMPRESSED_DIR]:
-    if not os.path.exists(path):
-        os.makedirs(path)
+# Create the output directories if they don't exist, once per process.
+# Importing this module has no side effects, whatever is about to write calls this
+@functools.cache
+def ensure_directories():
+    for path in [IMAGES_DIR, COMPRESSED_DIR, CACHE_DIR, FACES_DIR, THUMBNAILS_DIR, PRINTS_DIR]:
+        os.makedirs(path, exist_ok=True)
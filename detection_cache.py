@@ -0,0 +1,193 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# A detected face as (x, y, w, h) in image pixel coordinates
+FaceRect = tuple[int, int, int, int]
+
+
+class CacheStats:
+    """Hit, miss and eviction counters for a cache backend."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def as_dict(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class MemoryCache:
+    """Thread-safe, process-local LRU cache bounded by number of entries."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+        self._entries: OrderedDict[str, list[FaceRect]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> list[FaceRect] | None:
+        with self._lock:
+            if key not in self._entries:
+                self.stats.misses += 1
+                return None
+
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return self._entries[key]
+
+    def set(self, key: str, faces: list[FaceRect]):
+        with self._lock:
+            self._entries[key] = faces
+            self._entries.move_to_end(key)
+
+            # Drop least recently used entries over the limit
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class SQLiteCache:
+    """On-disk cache shared across restarts and worker processes."""
+
+    def __init__(self, db_path: str, max_entries: int):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+
+        # SQLite handles its own locking, this only guards the counters
+        self._stats_lock = threading.Lock()
+
+        with self._connect() as conn:
+            # WAL lets several processes read while one writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS faces ("
+                " key TEXT PRIMARY KEY, faces TEXT NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS faces_accessed ON faces (accessed)"
+            )
+
+    # A new connection per operation keeps the cache safe to use from any thread
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def get(self, key: str) -> list[FaceRect] | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT faces FROM faces WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                with self._stats_lock:
+                    self.stats.misses += 1
+                return None
+
+            conn.execute(
+                "UPDATE faces SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+
+        with self._stats_lock:
+            self.stats.hits += 1
+        return [tuple(rect) for rect in json.loads(row[0])]
+
+    def set(self, key: str, faces: list[FaceRect]):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO faces (key, faces, accessed) VALUES (?, ?, ?)",
+                (key, json.dumps(faces), time.time()),
+            )
+
+            # Drop least recently used entries over the limit
+            (count,) = conn.execute("SELECT COUNT(*) FROM faces").fetchone()
+            if count > self.max_entries:
+                evicted = conn.execute(
+                    "DELETE FROM faces WHERE key IN ("
+                    " SELECT key FROM faces ORDER BY accessed LIMIT ?)",
+                    (count - self.max_entries,),
+                ).rowcount
+                with self._stats_lock:
+                    self.stats.evictions += evicted
+
+    def __contains__(self, key: str) -> bool:
+        with self._connect() as conn:
+            row = conn.execute("SELECT 1 FROM faces WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM faces").fetchone()[0]
+
+
+class TieredCache:
+    """In-memory LRU in front of an on-disk store."""
+
+    def __init__(self, memory: MemoryCache, disk: SQLiteCache):
+        self.memory = memory
+        self.disk = disk
+        self.stats = CacheStats()
+        self._stats_lock = threading.Lock()
+
+    def get(self, key: str) -> list[FaceRect] | None:
+        faces = self.memory.get(key)
+        if faces is None:
+            faces = self.disk.get(key)
+            if faces is not None:
+                # Promote to memory for the next lookup
+                self.memory.set(key, faces)
+
+        with self._stats_lock:
+            if faces is None:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+            self._count_evictions()
+
+        return faces
+
+    def set(self, key: str, faces: list[FaceRect]):
+        self.memory.set(key, faces)
+        self.disk.set(key, faces)
+        with self._stats_lock:
+            self._count_evictions()
+
+    def _count_evictions(self):
+        self.stats.evictions = self.memory.stats.evictions + self.disk.stats.evictions
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.memory or key in self.disk
+
+    def __len__(self) -> int:
+        return len(self.disk)
+
+
+# Build the cache backend selected by name
+def create_cache(
+    backend: str, max_entries: int, db_path: str, disk_max_entries: int
+) -> MemoryCache | SQLiteCache | TieredCache:
+    if backend == "memory":
+        return MemoryCache(max_entries)
+    elif backend == "disk":
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        return SQLiteCache(db_path, disk_max_entries)
+    elif backend == "tiered":
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        return TieredCache(
+            MemoryCache(max_entries), SQLiteCache(db_path, disk_max_entries)
+        )
+
+    raise ValueError(f"Unknown face cache backend: {backend!r}")
@@ -1,26 +1,241 @@
+import argparse
+import functools
 import hashlib
+import os
+import threading
+from contextlib import contextmanager
 
-import cv2
 import numpy as np
 from PIL import Image
 from PIL.ImageFile import ImageFile
 
-# Cache to store detected faces
-face_cache = {}
+import constants as c
+import detection_cache
+import metrics
 
-# Preload the face detection model
-face_cascade = cv2.CascadeClassifier(
-    cv2.data.haarcascades + "haarcascade_frontalface_alt2.xml"
+
+# Cache to store detected faces, keyed by the content hash of the photo.
+# Opened on first use so importing this module stays cheap
+@functools.cache
+def get_face_cache():
+    return detection_cache.create_cache(
+        c.FACE_CACHE_BACKEND,
+        c.FACE_CACHE_MAX_ENTRIES,
+        c.FACE_CACHE_DB,
+        c.FACE_CACHE_DISK_MAX_ENTRIES,
+    )
+
+
+metrics.register_gauge(
+    "id_card_face_cache_hits_total",
+    "Face detection cache hits",
+    lambda: get_face_cache().stats.hits,
+    "counter",
+)
+metrics.register_gauge(
+    "id_card_face_cache_misses_total",
+    "Face detection cache misses",
+    lambda: get_face_cache().stats.misses,
+    "counter",
+)
+
+
+# Share of face cache lookups answered without running detection
+def cache_hit_ratio() -> float:
+    stats = get_face_cache().stats
+    return stats.hits / max(1, stats.hits + stats.misses)
+
+
+metrics.register_gauge(
+    "id_card_face_cache_hit_ratio",
+    "Share of face detection cache lookups that hit",
+    cache_hit_ratio,
 )
 
+# Photo extensions considered when warming the cache from a directory
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+# Load a face detection model, OpenCV is only imported then
+def load_face_cascade():
+    import cv2
+
+    return cv2.CascadeClassifier(
+        cv2.data.haarcascades + "haarcascade_frontalface_alt2.xml"
+    )
+
+
+class DetectorPool:
+    """Face detectors lent out one per concurrent detection, loaded as needed.
+    A classifier is never used by two threads at once, and at most size
+    detections run together; others wait for a free detector."""
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self.loaded = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._available = threading.Semaphore(self.size)
+
+    @contextmanager
+    def detector(self):
+        with self._available:
+            with self._lock:
+                cascade = self._idle.pop() if self._idle else None
+            if cascade is None:
+                cascade = load_face_cascade()
+                with self._lock:
+                    self.loaded += 1
+
+            try:
+                yield cascade
+            finally:
+                with self._lock:
+                    self._idle.append(cascade)
+
+
+# Threads OpenCV may use inside one detection so that pool_size detections at
+# once keep every core busy without oversubscribing them
+def opencv_threads(pool_size: int, threads: int = c.OPENCV_THREADS) -> int:
+    if threads:
+        return threads
+    return max(1, (os.cpu_count() or 1) // max(1, pool_size))
+
+
+# How many detections run at once and OpenCV's threads inside each, see constants
+detector_pool_size = c.DETECTOR_POOL_SIZE
+detector_threads = c.OPENCV_THREADS
+
+# Pool shared by every request and job thread, created on first detection
+_detector_pool: DetectorPool | None = None
+_detector_pool_lock = threading.Lock()
+
+
+# Size the detector pool and OpenCV's threads for how many detections run at once,
+# e.g. 1 in each batch worker process. Call before the first detection
+def configure_detectors(pool_size: int, threads: int = c.OPENCV_THREADS):
+    global detector_pool_size, detector_threads, _detector_pool
+    with _detector_pool_lock:
+        detector_pool_size, detector_threads = pool_size, threads
+        _detector_pool = None
+
+
+# Create the shared pool once, even when the first detections start together
+def get_detector_pool() -> DetectorPool:
+    global _detector_pool
+    if _detector_pool is not None:
+        return _detector_pool
+
+    with _detector_pool_lock:
+        if _detector_pool is None:
+            # -1 leaves OpenCV's own thread count alone
+            if detector_threads >= 0:
+                import cv2
+
+                cv2.setNumThreads(opencv_threads(detector_pool_size, detector_threads))
+
+            _detector_pool = DetectorPool(detector_pool_size)
+
+        return _detector_pool
+
+
+# Size of the blocks read while hashing a photo
+HASH_CHUNK_SIZE = 1024 * 1024
+
 
 # Calculate the hash of the image to use as a key in the cache
 def calculate_image_hash(image_path: str) -> str:
+    md5 = hashlib.md5()
+
+    # Stream the file in chunks instead of holding all of it in memory
     with open(image_path, "rb") as f:
-        image_data = f.read()
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+# Smallest face searched for, in full-resolution pixels
+MIN_FACE_SIZE = (30, 50)
+
+# Window size the Haar cascade was trained on; smaller minimums are meaningless
+CASCADE_WINDOW = 20
+
+
+# Run the Haar cascade on a grayscale image, scaling the minimum face size with it
+def _run_cascade(gray: np.ndarray, scale: float) -> np.ndarray:
+    min_size = tuple(max(CASCADE_WINDOW, round(side * scale)) for side in MIN_FACE_SIZE)
+
+    with get_detector_pool().detector() as cascade:
+        return cascade.detectMultiScale(
+            gray, scaleFactor=1.1, minNeighbors=5, minSize=min_size
+        )
+
+
+# Resize a grayscale image so its longest side is at most max_side
+def _downscale(gray: np.ndarray, max_side: int) -> tuple[np.ndarray, float]:
+    height, width = gray.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return gray, 1.0
+
+    import cv2
+
+    scale = max_side / max(height, width)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA), scale
 
-    # Calculate the MD5 hash of the image data
-    return hashlib.md5(image_data).hexdigest()
+
+# Re-detect a face inside a padded region of the full-resolution image
+def _refine_face(
+    gray: np.ndarray, rect: tuple[int, int, int, int], max_side: int
+) -> tuple[int, int, int, int]:
+    x, y, w, h = rect
+    pad = int(max(w, h) * c.DETECTION_REFINE_PADDING)
+
+    left, top = max(x - pad, 0), max(y - pad, 0)
+    right = min(x + w + pad, gray.shape[1])
+    bottom = min(y + h + pad, gray.shape[0])
+
+    region, scale = _downscale(gray[top:bottom, left:right], max_side)
+    faces = _run_cascade(region, scale)
+
+    if len(faces) == 0:
+        # Keep the coarse detection
+        return rect
+
+    # The largest detection in the region is the face we zoomed in on
+    rx, ry, rw, rh = max(faces, key=lambda r: r[2] * r[3])
+    return (
+        left + int(rx / scale),
+        top + int(ry / scale),
+        int(rw / scale),
+        int(rh / scale),
+    )
+
+
+# Detect faces on a downscaled copy and map them back to full-resolution coordinates
+def detect_faces(
+    gray: np.ndarray,
+    max_side: int = c.DETECTION_MAX_SIDE,
+    refine: bool = c.DETECTION_REFINE,
+) -> list[tuple[int, int, int, int]]:
+    small, scale = _downscale(gray, max_side)
+    faces = [
+        (int(x / scale), int(y / scale), int(w / scale), int(h / scale))
+        for x, y, w, h in _run_cascade(small, scale)
+    ]
+
+    # Refining only helps when detection ran below full resolution
+    if refine and scale < 1.0:
+        faces = [_refine_face(gray, rect, max_side) for rect in faces]
+
+    # Plain tuples so the result can be stored by any cache backend
+    return [tuple(int(v) for v in rect) for rect in faces]
+
+
+# Cache key for a photo, including the detection settings that shape the result
+def detection_key(image_hash: str) -> str:
+    return f"{image_hash}:{c.DETECTION_MAX_SIDE}:{int(c.DETECTION_REFINE)}"
 
 
 def crop_to_square(image: ImageFile) -> ImageFile:
@@ -41,40 +256,39 @@ def crop_to_square(image: ImageFile) -> ImageFile:
         return image.crop((0, top, width, bottom))
 
 
-# Detect the face in the image and crop it so the face occupies the target_face_size in a square output
-def crop_face_to_square(
-    image: ImageFile, target_face_size: float, face_num: int
-) -> tuple[ImageFile, str]:
+# Detect every face in a photo, sorted from left to right. The photo is decoded
+# here and stays decoded, so any number of faces can then be cropped from it.
+# image_hash is the photo file's hash when the caller already has it
+def detect_photo_faces(
+    image: ImageFile, image_hash: str | None = None
+) -> list[tuple[int, int, int, int]]:
+    # Hash the file before anything is decoded, PIL only has the header so far
+    if image_hash is None:
+        with metrics.stage("hash"):
+            image_hash = calculate_image_hash(image.filename)
+    cache_key = detection_key(image_hash)
 
-    # Generate a unique hash for the image
-    image_hash = calculate_image_hash(image.filename)
-
-    # Convert PIL Image to OpenCV format
-    image_cv = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-    gray = cv2.cvtColor(image_cv, cv2.COLOR_BGR2GRAY)
-
-    faces = []
+    with metrics.stage("decode"):
+        image.load()
 
     # Check if faces for this image are already cached
-    if image_hash in face_cache:
-        faces = face_cache[image_hash]
-    else:
-        # Detect faces in the image
-        faces = face_cascade.detectMultiScale(
-            gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 50)
-        )
+    face_cache = get_face_cache()
+    faces = face_cache.get(cache_key)
+    if faces is None:
+        # Detection only needs grayscale, no colour copies of the photo
+        with metrics.stage("detect"):
+            faces = detect_faces(np.asarray(image.convert("L")))
+        face_cache.set(cache_key, faces)
 
-        face_cache[image_hash] = faces
+    # Sort faces by x-coordinate
+    return sorted(faces, key=lambda rect: rect[0])
 
-    if len(faces) == 0:
-        return None, "No face detected. Please try another image."
 
-    elif len(faces) > 1:
-        # Sort faces by x-coordinate
-        faces = sorted(faces, key=lambda rect: rect[0])
-
-    # Get the face coordinates of the first_num-th face from left to right
-    x, y, w, h = faces[min(face_num, len(faces)) - 1]
+# Crop a square around a face so the face occupies target_face_size of it
+def crop_face(
+    image: ImageFile, face: tuple[int, int, int, int], target_face_size: float
+) -> ImageFile:
+    x, y, w, h = face
 
     # Calculate new crop dimensions to make the face cover target_face_size % of image
     face_center_x, face_center_y = x + w // 2, y + h // 2
@@ -83,21 +297,86 @@ def crop_face_to_square(
     desired_crop_size = int(max(w, h) / target_face_size)
 
     # Make the crop area square while ensuring it fits the image
-    half_square_crop_size = min(desired_crop_size, *image_cv.shape[:2]) // 2
+    width, height = image.size
+    half_square_crop_size = min(desired_crop_size, width, height) // 2
 
     # Calculate the crop coordinates
     left = max(face_center_x - half_square_crop_size, 0)
     top = max(face_center_y - half_square_crop_size, 0)
-    right = min(face_center_x + half_square_crop_size, image_cv.shape[1])
-    bottom = min(face_center_y + half_square_crop_size, image_cv.shape[0])
+    right = min(face_center_x + half_square_crop_size, width)
+    bottom = min(face_center_y + half_square_crop_size, height)
+
+    with metrics.stage("crop"):
+        # Crop the image directly in PIL
+        img_pil = image.crop((left, top, right, bottom))
+        if img_pil.mode != "RGB":
+            img_pil = img_pil.convert("RGB")
+
+        # Ensuring square output
+        return crop_to_square(img_pil)
+
+
+# The face_num-th face from the left of faces sorted by detect_photo_faces,
+# face numbers past the last face give the last face
+def select_face(
+    faces: list[tuple[int, int, int, int]], face_num: int
+) -> tuple[int, int, int, int]:
+    return faces[min(face_num, len(faces)) - 1]
+
+
+# Detect the face in the image and crop it so the face occupies the target_face_size in a square output
+def crop_face_to_square(
+    image: ImageFile,
+    target_face_size: float,
+    face_num: int,
+    image_hash: str | None = None,
+) -> tuple[ImageFile, str]:
+    faces = detect_photo_faces(image, image_hash)
+    if len(faces) == 0:
+        return None, "No face detected. Please try another image."
+
+    # Get the face coordinates of the first_num-th face from left to right
+    face = select_face(faces, face_num)
+
+    return (
+        crop_face(image, face, target_face_size),
+        "Face detected and cropped successfully.",
+    )
+
+
+# Detect faces for every photo in a directory so later requests hit the cache
+def warm_cache(photo_dir: str) -> dict[str, int]:
+    warmed, skipped = 0, 0
+    face_cache = get_face_cache()
 
-    # Crop the image
-    cropped_img = image_cv[top:bottom, left:right]
+    for filename in sorted(os.listdir(photo_dir)):
+        if not filename.lower().endswith(PHOTO_EXTENSIONS):
+            continue
 
-    # Convert back to PIL format for Gradio compatibility
-    img_pil = Image.fromarray(cv2.cvtColor(cropped_img, cv2.COLOR_BGR2RGB))
+        image_path = os.path.join(photo_dir, filename)
+        cache_key = detection_key(calculate_image_hash(image_path))
 
-    # Ensuring square output
-    square_img_pil = crop_to_square(img_pil)
+        if cache_key in face_cache:
+            skipped += 1
+            continue
 
-    return square_img_pil, "Face detected and cropped successfully."
+        with Image.open(image_path) as image:
+            gray = np.asarray(image.convert("L"))
+        face_cache.set(cache_key, detect_faces(gray))
+        warmed += 1
+
+    return {"warmed": warmed, "skipped": skipped, **face_cache.stats.as_dict()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Face detection cache tools")
+    parser.add_argument(
+        "--warm", metavar="DIR", help="Warm the cache from a photo directory"
+    )
+    args = parser.parse_args()
+
+    if args.warm:
+        print(warm_cache(args.warm))
+    else:
+        face_cache = get_face_cache()
+        print(f"{len(face_cache)} photo(s) cached, {face_cache.stats.as_dict()}")
@@ -0,0 +1,44 @@
+import hashlib
+import os
+
+from PIL import Image
+
+import card_store
+import constants as c
+
+
+# Key of a face crop, derived from its pixels so identical crops are stored once
+def face_key(image: Image.Image) -> str:
+    sha = hashlib.sha256(f"{image.mode}:{image.size}:".encode())
+    sha.update(image.tobytes())
+    return sha.hexdigest()
+
+
+# Path of a stored face, sharded by the first characters of its key
+def face_path(key: str) -> str:
+    return os.path.join(c.FACES_DIR, key[:2], f"{key}.png")
+
+
+# Store a cropped face at its native resolution and return its key
+def save_face(image: Image.Image) -> str:
+    key = face_key(image)
+    path = face_path(key)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        card_store.write_atomic(
+            path,
+            lambda f: image.save(f, "PNG", compress_level=c.FACE_STORE_COMPRESS_LEVEL),
+        )
+
+    return key
+
+
+# Load a stored face, or None if it is missing
+def load_face(key: str | None) -> Image.Image | None:
+    if not key or not os.path.exists(face_path(key)):
+        return None
+
+    image = Image.open(face_path(key))
+    image.load()
+    return image
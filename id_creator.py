@@ -1,8 +1,35 @@
-from PIL import Image, ImageDraw, ImageFont
+import io
+import os
+
+from PIL import Image
 from PIL.ImageFile import ImageFile
 
+import card_index
+import card_store
 import constants as c
 import face_processor
+import face_store
+import layout
+import metrics
+import single_flight
+import thumbnails
+
+
+# Encode a card with the settings of an output profile
+def encode_card(card: Image.Image, profile: str = c.OUTPUT_PROFILE) -> bytes:
+    settings = c.OUTPUT_PROFILES[profile]
+    if settings["format"] == "JPEG" and card.mode != "RGB":
+        card = card.convert("RGB")
+
+    buffer = io.BytesIO()
+    card.save(buffer, settings["format"], **settings["options"])
+    return buffer.getvalue()
+
+
+# Encode a card with the settings of an output profile and write it to a path
+def save_card(card: Image.Image, output_path: str, profile: str = c.OUTPUT_PROFILE):
+    with open(output_path, "wb") as f:
+        f.write(encode_card(card, profile))
 
 
 # Format the phone number into two groups of 5 digits
@@ -34,16 +61,11 @@ def validate_text(name: str, post: str):
     return True, (pname.title(), ppost.title())
 
 
-# Generate ID card with given image and applicant details
-def generate_id_card(
-    person_image: ImageFile,
-    target_face_size: float,
-    face_num: int,
-    force_image: bool,
-    name: str,
-    phone: str,
-    post: str,
-):
+# Validate and format the applicant details, returning (name, phone, post)
+# or None and the reason they are invalid
+def prepare_details(
+    name: str, phone: str, post: str
+) -> tuple[tuple[str, str, str] | None, str]:
     # Validate name and post
     valid_text, text_result = validate_text(name, post)
     if not valid_text:
@@ -55,117 +77,260 @@ def generate_id_card(
         return None, phone_result
 
     name, post = text_result
-    formatted_phone = phone_result
-
-    # Load the template
-    template = Image.open(c.TEMPLATE_PATH)
+    return (name, phone_result, post), ""
+
+
+# Get the compiled layout of a template, or None and the reason it failed to load
+def load_plan(template: str | None) -> tuple[layout.LayoutPlan | None, str]:
+    try:
+        with metrics.stage("template"):
+            return layout.get_layout_plan(template), ""
+    except (OSError, ValueError) as e:
+        return None, f"Could not load template {template}: {e}"
+
+
+# Filename of a card without its extension: name, phone and post, then the
+# template's tag after an @ unless it is the default, so cards of one member
+# made with different templates never overwrite each other
+def card_stem(details: tuple[str, str, str], template: str | None = None) -> str:
+    name, formatted_phone, post = details
+    stem = (
+        f"ID_Card_{name.replace(' ', '_')}_"
+        f"{formatted_phone.replace(' ', '')}_{post.replace(' ', '_')}"
+    )
 
-    if force_image:
-        person_img = (
-            Image.open(person_image) if type(person_image) == str else person_image
-        )
-        person_img = face_processor.crop_to_square(person_img)
-    else:
-        # Open and process the person's image
-        person_img = Image.open(person_image)
+    # Details like "HR/Admin" must not turn into directories
+    for separator in {os.sep, os.altsep} - {None}:
+        stem = stem.replace(separator, "-")
 
-        person_img, msg = face_processor.crop_face_to_square(
-            person_img, target_face_size, face_num
-        )
+    tag = layout.template_tag(template)
+    return f"{stem}@{tag}" if tag else stem
 
-        if person_img is None:
-            return None, msg
 
-    # Resize the image to fit the template
-    person_img = person_img.resize(c.PICTURE_SIZE)
+# Render, save and record a card from an already cropped square photo
+def render_card(
+    person_img: Image.Image,
+    details: tuple[str, str, str],
+    plan: layout.LayoutPlan,
+    template: str | None = None,
+) -> tuple[str, str]:
+    name, formatted_phone, post = details
 
-    # Paste the image onto the template
-    template.paste(person_img, c.PICTURE_POSITION)
+    # Keep the full resolution crop so regeneration never has to cut it back out
+    with metrics.stage("face_store"):
+        face_key = face_store.save_face(person_img)
 
-    draw = ImageDraw.Draw(template)
-    font = ImageFont.truetype(c.FONT_PATH, c.FONT_SIZE)
+    # Render the photo and details onto the template
+    with metrics.stage("composite"):
+        card = plan.composite(person_img)
+    with metrics.stage("text"):
+        plan.draw_text(card, {"name": name, "phone": formatted_phone, "post": post})
 
-    # Calculate required size and position for text
-    max_headings_width = 0
-    for heading in c.TEXT_HEADINGS:
-        max_headings_width = max(
-            max_headings_width, draw.textlength(heading, font=font)
+    # Save the final ID card with name, phone, and post in filename
+    stem = card_stem(details, template)
+    filename = f"{stem}.{c.IMAGE_EXTENSION}"
+    store = card_store.get_card_store()
+
+    # Written atomically, readers see the old card or the new one, never half of one
+    with metrics.stage("encode"):
+        output_path = store.save(filename, encode_card(card))
+
+    # The same card saved earlier with another profile's extension is out of date
+    for extension in c.OUTPUT_EXTENSIONS:
+        old_filename = stem + extension
+        if old_filename != filename and store.delete(old_filename):
+            card_index.index.remove_filename(old_filename)
+
+    # Make the list preview while the card is still decoded in memory
+    with metrics.stage("thumbnail"):
+        thumbnails.create_thumbnail(output_path, card)
+
+    # Record the card so the list view never has to scan the output directory
+    with metrics.stage("index"):
+        card_index.index.upsert(
+            output_path,
+            name,
+            formatted_phone.replace(" ", ""),
+            post,
+            photo_box=plan.photo_box,
+            fingerprint=plan.fingerprint,
+            face_key=face_key,
+            template=template or layout.DEFAULT_TEMPLATE,
         )
 
-    colon_width = draw.textlength(":", font=font)
+    return output_path, "ID card generated successfully!"
 
-    max_input_width = max(
-        draw.textlength(name, font=font),
-        draw.textlength(formatted_phone, font=font),
-        draw.textlength(post, font=font),
-    )
 
-    total_width = (
-        max_headings_width
-        + c.PADDING_HEADING
-        + colon_width
-        + c.PADDING_INPUT
-        + max_input_width
+# Key of a generate request: what decides the card, with the details as
+# prepare_details formats them, the photo by content and the template by fingerprint
+def generate_key(
+    image_hash: str,
+    target_face_size: float,
+    face_num: int,
+    force_image: bool,
+    name: str,
+    phone: str,
+    post: str,
+    template: str | None = None,
+) -> tuple:
+    details, _ = prepare_details(name, phone, post)
+
+    try:
+        fingerprint = layout.get_layout_plan(template).fingerprint
+    except (OSError, ValueError):
+        fingerprint = None
+
+    return (
+        image_hash,
+        # The face options only matter when the face is searched for
+        None if force_image else (float(target_face_size), int(face_num)),
+        # Details as they end up on the card, or as given when invalid
+        details or (name, phone, post),
+        template or layout.DEFAULT_TEMPLATE,
+        fingerprint,
+        c.OUTPUT_PROFILE,
     )
 
-    # Check if the text fits in the template if started from set position
-    text_position = c.TEXT_POSITION
-    if total_width + c.TEXT_POSITION[0] > template.size[0]:
-        text_position = ((template.size[0] - total_width) // 2, c.TEXT_POSITION[1])
-
-    # Add name, phone, and post headings
-    draw.text(
-        text_position,
-        "\n".join(c.TEXT_HEADINGS),
-        fill="black",
-        font=font,
-        stroke_fill="white",
-        stroke_width=8,
-        spacing=16,
-    )
 
-    colon_position = (
-        text_position[0] + max_headings_width + c.PADDING_HEADING,
-        text_position[1],
-    )
+# Identical generate requests, such as a double-clicked button, share one run
+generate_flight = single_flight.SingleFlight("generate")
 
-    # Add the colons
-    draw.text(
-        colon_position,
-        "\n".join([":"] * len(c.TEXT_HEADINGS)),
-        fill="black",
-        font=font,
-        stroke_fill="white",
-        stroke_width=8,
-        spacing=16,
-    )
 
-    input_position = (
-        text_position[0]
-        + max_headings_width
-        + c.PADDING_HEADING
-        + colon_width
-        + c.PADDING_INPUT,
-        text_position[1],
+# Generate ID card with given image and applicant details, using the
+# default template unless another template spec is given. Requests for a photo
+# file are coalesced with identical ones running or just finished
+@metrics.timed_request("generate")
+def generate_id_card(
+    person_image: ImageFile,
+    target_face_size: float,
+    face_num: int,
+    force_image: bool,
+    name: str,
+    phone: str,
+    post: str,
+    template: str | None = None,
+):
+    args = (
+        person_image,
+        target_face_size,
+        face_num,
+        force_image,
+        name,
+        phone,
+        post,
+        template,
     )
 
-    # Add name, phone, and post inputs
-    draw.text(
-        input_position,
-        "\n".join([name, formatted_phone, post]),
-        fill="black",
-        font=font,
-        stroke_fill="white",
-        stroke_width=8,
-        spacing=16,
+    # Images already in memory, as when regenerating, have no file to key on
+    if not isinstance(person_image, str):
+        return _generate_id_card(*args)
+
+    # Hashed once, for the key and then for the face cache
+    with metrics.stage("hash"):
+        image_hash = face_processor.calculate_image_hash(person_image)
+
+    return generate_flight.do(
+        generate_key(image_hash, *args[1:]),
+        _generate_id_card,
+        *args,
+        image_hash=image_hash,
+        # A card deleted since is made again
+        valid=lambda result: result[0] is None or os.path.exists(result[0]),
     )
 
-    # Save the final ID card with name, phone, and post in filename
-    output_path = (
-        f"{c.IMAGES_OUTPUT_PATH}ID_Card_{name.replace(' ', '_')}_"
-        f"{formatted_phone.replace(' ', '')}_{post.replace(' ', '_')}.{c.IMAGE_EXTENSION}"
-    )
 
-    template.save(output_path)
+def _generate_id_card(
+    person_image: ImageFile,
+    target_face_size: float,
+    face_num: int,
+    force_image: bool,
+    name: str,
+    phone: str,
+    post: str,
+    template: str | None = None,
+    image_hash: str | None = None,
+):
+    details, message = prepare_details(name, phone, post)
+    if details is None:
+        return None, message
 
-    return output_path, "ID card generated successfully!"
+    c.ensure_directories()
+
+    plan, message = load_plan(template)
+    if plan is None:
+        return None, message
+
+    if force_image:
+        person_img = (
+            Image.open(person_image) if type(person_image) == str else person_image
+        )
+        with metrics.stage("crop"):
+            person_img = face_processor.crop_to_square(person_img)
+    else:
+        # Open and process the person's image
+        person_img = Image.open(person_image)
+
+        person_img, msg = face_processor.crop_face_to_square(
+            person_img, target_face_size, face_num, image_hash
+        )
+
+        if person_img is None:
+            return None, msg
+
+    return render_card(person_img, details, plan, template)
+
+
+# Generate cards for several members in one group photo, reading, decoding and
+# detecting faces once. Each member is a dict with name, phone and post, and
+# optionally face_num (1 is the leftmost face), target_face_size and template.
+# Returns (output path, message) for each member in order
+@metrics.timed_request("generate_group")
+def generate_group_id_cards(
+    person_image: str, members: list[dict]
+) -> list[tuple[str | None, str]]:
+    results = [None] * len(members)
+
+    # Check every member before touching the photo
+    prepared = {}
+    for index, member in enumerate(members):
+        details, message = prepare_details(
+            member["name"], member["phone"], member["post"]
+        )
+        if details is None:
+            results[index] = (None, message)
+            continue
+
+        plan, message = load_plan(member.get("template"))
+        if plan is None:
+            results[index] = (None, message)
+            continue
+
+        prepared[index] = (details, plan)
+
+    if not prepared:
+        return results
+
+    c.ensure_directories()
+
+    image = Image.open(person_image)
+    faces = face_processor.detect_photo_faces(image)
+
+    for index, (details, plan) in prepared.items():
+        if len(faces) == 0:
+            results[index] = (None, "No face detected. Please try another image.")
+            continue
+
+        # One member failing leaves the cards of the others
+        member = members[index]
+        try:
+            face = face_processor.select_face(faces, int(member.get("face_num") or 1))
+            person_img = face_processor.crop_face(
+                image, face, float(member.get("target_face_size") or 0.5)
+            )
+            results[index] = render_card(
+                person_img, details, plan, member.get("template")
+            )
+        except Exception as e:
+            results[index] = (None, f"{type(e).__name__}: {e}")
+
+    return results
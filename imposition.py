@@ -0,0 +1,87 @@
+import numpy as np
+
+import constants as c
+
+
+class SheetLayout:
+    """Grid of card slots on one sheet size, spaced equally everywhere."""
+
+    def __init__(
+        self,
+        sheet_size: tuple[float, float] = c.SHEET_RATIO,
+        card_size: tuple[float, float] = c.IMAGE_RATIO,
+    ):
+        self.sheet_size = tuple(sheet_size)
+        self.card_size = tuple(card_size)
+
+        # Number of cards in each row and column
+        self.columns = int(self.sheet_size[0] / self.card_size[0])
+        self.rows = int(self.sheet_size[1] / self.card_size[1])
+        if self.columns < 1 or self.rows < 1:
+            raise ValueError(
+                f"A {self.card_size[0]}x{self.card_size[1]} card does not fit "
+                f"on a {self.sheet_size[0]}x{self.sheet_size[1]} sheet"
+            )
+
+        self.spacing = (
+            (self.sheet_size[0] - self.columns * self.card_size[0])
+            / (self.columns + 1),
+            (self.sheet_size[1] - self.rows * self.card_size[1]) / (self.rows + 1),
+        )
+
+        # Top-left corner of every slot, filling each row before the next one
+        i, j = np.meshgrid(np.arange(self.columns), np.arange(self.rows))
+        i, j = i.ravel(), j.ravel()
+        self.slots = np.column_stack(
+            (
+                self.card_size[0] * i + self.spacing[0] * (i + 1),
+                self.card_size[1] * j + self.spacing[1] * (j + 1),
+            )
+        )
+
+    @property
+    def capacity(self) -> int:
+        return self.columns * self.rows
+
+
+# Card index of every placement, with each card repeated for its copies
+def expand_copies(copies: list[int]) -> np.ndarray:
+    return np.repeat(np.arange(len(copies)), copies)
+
+
+# Place count cards over sheets using the layouts in order, repeating the last
+# layout for as many sheets as needed. Returns the layout of every sheet and the
+# sheet number and top-left corner of every placement
+def impose(
+    count: int, layouts: list[SheetLayout]
+) -> tuple[list[SheetLayout], np.ndarray, np.ndarray]:
+    if not layouts:
+        raise ValueError("At least one sheet layout is needed")
+
+    capacities = np.array([layout.capacity for layout in layouts])
+
+    # Sheets needed past the listed layouts, all using the last one
+    overflow = max(0, count - int(capacities.sum()))
+    extra_sheets = -(-overflow // int(capacities[-1]))
+    sheet_layouts = np.concatenate(
+        (np.arange(len(layouts)), np.full(extra_sheets, len(layouts) - 1))
+    )
+
+    # Placement number at which each sheet ends, and the sheet of every placement
+    sheet_ends = np.cumsum(capacities[sheet_layouts])
+    placements = np.arange(count)
+    sheets = np.searchsorted(sheet_ends, placements, side="right")
+    slots = placements - (sheet_ends - capacities[sheet_layouts])[sheets]
+
+    # Look the corners up in the slots of all layouts laid end to end
+    all_slots = np.concatenate([layout.slots for layout in layouts])
+    slot_offsets = np.concatenate(([0], np.cumsum(capacities)[:-1]))
+    positions = all_slots[slot_offsets[sheet_layouts[sheets]] + slots]
+
+    # Keep at least one sheet even with nothing to place
+    sheet_count = int(sheets[-1]) + 1 if count else 1
+    return (
+        [layouts[index] for index in sheet_layouts[:sheet_count]],
+        sheets,
+        positions,
+    )
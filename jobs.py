@@ -0,0 +1,199 @@
+import functools
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable
+
+
+class JobCancelled(Exception):
+    """Raised from a job's progress callback once the job has been cancelled."""
+
+
+class Job:
+    """A long-running operation with progress, cancellation and timing."""
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex[:8]
+        self.name = name
+        self.status = "queued"  # queued, running, done, failed or cancelled
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.message = ""
+
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    # Seconds spent waiting in the queue and running
+    @property
+    def timing(self) -> tuple[float, float]:
+        now = time.time()
+        started = self.started_at or now
+        return started - self.created_at, (self.finished_at or now) - started
+
+    def as_row(self) -> list[str]:
+        waited, ran = self.timing
+        progress = f"{self.done}/{self.total}" if self.total else "-"
+        return [
+            self.id,
+            self.name,
+            self.status,
+            progress,
+            f"{waited:.1f}s",
+            f"{ran:.1f}s",
+            self.message,
+        ]
+
+
+class JobManager:
+    """Runs jobs in the background with a limit on how many run at once."""
+
+    def __init__(self, max_concurrent: int, history: int = 50):
+        self.history = history
+        self.shared = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrent, thread_name_prefix="job"
+        )
+        self._jobs: dict[str, Job] = {}
+        # Jobs queued or running under a key, see submit_shared
+        self._shared: dict[Hashable, list[Job]] = {}
+        self._lock = threading.Lock()
+
+    # Queue fn(*args, on_progress=..., **kwargs) as a job
+    def submit(self, name: str, fn: Callable, *args, **kwargs) -> Job:
+        return self.submit_shared(None, name, fn, *args, **kwargs)
+
+    # Queue fn like submit, unless a job with the same key is queued or running.
+    # Then the new job follows that run's progress and result instead of queueing
+    # another. Cancelling one of those jobs only ends that job, the run stops
+    # once every job following it is cancelled. A key of None is never shared
+    def submit_shared(
+        self, key: Hashable | None, name: str, fn: Callable, *args, **kwargs
+    ) -> Job:
+        job = Job(name)
+
+        with self._lock:
+            group = self._shared.get(key) if key is not None else None
+            if group is not None:
+                # Join the run where it is
+                leader = group[0]
+                job.status, job.started_at = leader.status, leader.started_at
+                job.done, job.total = leader.done, leader.total
+                group.append(job)
+                self.shared += 1
+            else:
+                group = [job]
+                if key is not None:
+                    self._shared[key] = group
+
+            self._jobs[job.id] = job
+
+            # Forget the oldest finished jobs beyond the history limit
+            finished = [j for j in self._jobs.values() if j.finished]
+            for old_job in finished[: max(0, len(self._jobs) - self.history)]:
+                del self._jobs[old_job.id]
+
+        if group[0] is job:
+            self._executor.submit(self._run, key, group, fn, args, kwargs)
+        return job
+
+    # Jobs still wanting the run, marking the cancelled ones as finished
+    def _live(self, group: list[Job]) -> list[Job]:
+        with self._lock:
+            jobs = list(group)
+
+        live = []
+        for job in jobs:
+            if not job.cancelled:
+                live.append(job)
+            elif not job.finished:
+                job.status = "cancelled"
+                job.message = "Cancelled"
+                job.started_at = job.started_at or time.time()
+                job.finished_at = time.time()
+        return live
+
+    # Progress callback handed to the work function, also where cancellation lands
+    def _progress(self, group: list[Job], done: int, total: int):
+        live = self._live(group)
+        if not live:
+            raise JobCancelled()
+        for job in live:
+            job.done, job.total = done, total
+
+    def _run(
+        self,
+        key: Hashable | None,
+        group: list[Job],
+        fn: Callable,
+        args: tuple,
+        kwargs: dict,
+    ):
+        try:
+            # Cancelled while still queued
+            live = self._live(group)
+            if not live:
+                return
+
+            started_at = time.time()
+            for job in live:
+                job.status = "running"
+                job.started_at = started_at
+
+            try:
+                on_progress = functools.partial(self._progress, group)
+                result = fn(*args, on_progress=on_progress, **kwargs)
+                status = "done"
+                message = result if isinstance(result, str) else "Finished"
+            except JobCancelled:
+                result, status, message = None, "cancelled", "Cancelled"
+            except Exception as e:
+                result, status, message = None, "failed", f"{type(e).__name__}: {e}"
+        finally:
+            # Jobs submitted from here on start a run of their own
+            with self._lock:
+                if key is not None:
+                    del self._shared[key]
+
+        finished_at = time.time()
+        for job in self._live(group):
+            job.result, job.status, job.message = result, status, message
+            job.finished_at = finished_at
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> str:
+        job = self.get(job_id)
+        if job is None:
+            return f"No job with ID {job_id}."
+        if job.finished:
+            return f"Job {job_id} already {job.status}."
+
+        job.cancel()
+        return f"Cancelling job {job_id}..."
+
+    # All known jobs, newest first
+    def list(self) -> list[Job]:
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)
+
+    # Number of jobs waiting for a free slot
+    def queue_depth(self) -> int:
+        return sum(job.status == "queued" for job in self.list())
@@ -0,0 +1,375 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import tomllib
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw, ImageFont
+
+import constants as c
+
+# Name of the template built from the constants module
+DEFAULT_TEMPLATE = "default"
+
+# What to do when the text block is wider than the template from its set position
+OVERFLOW_RULES = ("center", "none")
+
+# Details a template's text fields can show
+FIELD_KEYS = ("name", "phone", "post")
+
+# Keys every section of a template spec file must have
+SPEC_SECTION_KEYS = {
+    "photo": ("position", "size"),
+    "font": ("path", "size"),
+    "text": ("position",),
+}
+
+DEFAULT_TEXT_STYLE = {
+    "fill": "black",
+    "stroke_fill": "white",
+    "stroke_width": 8,
+    "spacing": 16,
+}
+
+
+# Template spec equivalent to the layout constants
+def default_template_spec() -> dict:
+    return {
+        "name": DEFAULT_TEMPLATE,
+        "image": c.TEMPLATE_PATH,
+        "photo": {"position": c.PICTURE_POSITION, "size": c.PICTURE_SIZE},
+        "font": {"path": c.FONT_PATH, "size": c.FONT_SIZE},
+        "text": {
+            "position": c.TEXT_POSITION,
+            "padding_heading": c.PADDING_HEADING,
+            "padding_input": c.PADDING_INPUT,
+            "overflow": "center",
+            **DEFAULT_TEXT_STYLE,
+        },
+        "fields": [
+            {"key": key, "heading": heading}
+            for key, heading in zip(FIELD_KEYS, c.TEXT_HEADINGS)
+        ],
+    }
+
+
+# Read a template spec from a JSON or TOML file, with paths relative to the file
+def load_template_spec(spec_path: str) -> dict:
+    if spec_path.lower().endswith(".toml"):
+        with open(spec_path, "rb") as f:
+            spec = tomllib.load(f)
+    else:
+        with open(spec_path, encoding="utf-8") as f:
+            spec = json.load(f)
+
+    for key in ("image", "photo", "font", "text", "fields"):
+        if key not in spec:
+            raise ValueError(f"{spec_path}: missing '{key}'")
+
+    # Sections and the keys each must have
+    for section, keys in SPEC_SECTION_KEYS.items():
+        if not isinstance(spec[section], dict):
+            raise ValueError(f"{spec_path}: '{section}' must be a table")
+        for key in keys:
+            if key not in spec[section]:
+                raise ValueError(f"{spec_path}: missing '{section}.{key}'")
+
+    if not isinstance(spec["fields"], list) or not spec["fields"]:
+        raise ValueError(f"{spec_path}: 'fields' must be a non-empty list")
+    for field in spec["fields"]:
+        if not isinstance(field, dict) or not {"key", "heading"} <= field.keys():
+            raise ValueError(f"{spec_path}: every field needs a 'key' and 'heading'")
+
+    spec_dir = os.path.dirname(spec_path)
+    spec["image"] = os.path.join(spec_dir, spec["image"])
+    spec["font"]["path"] = os.path.join(spec_dir, spec["font"]["path"])
+    spec.setdefault("name", os.path.splitext(os.path.basename(spec_path))[0])
+
+    return spec
+
+
+class LayoutPlan:
+    """A template spec compiled into everything a card render can reuse."""
+
+    def __init__(self, spec: dict, spec_path: str | None = None):
+        self.spec_path = spec_path
+        self.name = spec["name"]
+        self.image_path = spec["image"]
+        self.font_path = spec["font"]["path"]
+        self.font_size = spec["font"]["size"]
+
+        self.photo_position = tuple(spec["photo"]["position"])
+        self.photo_size = tuple(spec["photo"]["size"])
+        self.photo_box = (
+            self.photo_position[0],
+            self.photo_position[1],
+            self.photo_position[0] + self.photo_size[0],
+            self.photo_position[1] + self.photo_size[1],
+        )
+
+        text = spec["text"]
+        self.text_position = tuple(text["position"])
+        self.padding_heading = text.get("padding_heading", c.PADDING_HEADING)
+        self.padding_input = text.get("padding_input", c.PADDING_INPUT)
+        self.overflow = text.get("overflow", "center")
+        if self.overflow not in OVERFLOW_RULES:
+            raise ValueError(f"Unknown overflow rule: {self.overflow!r}")
+        self.text_style = {
+            key: text.get(key, value) for key, value in DEFAULT_TEXT_STYLE.items()
+        }
+
+        self.field_keys = [field["key"] for field in spec["fields"]]
+        unknown = [key for key in self.field_keys if key not in FIELD_KEYS]
+        if unknown:
+            raise ValueError(f"Unknown text fields {unknown}, use any of {FIELD_KEYS}")
+        self.headings = [field["heading"] for field in spec["fields"]]
+
+        self.mtimes = self._current_mtimes()
+
+        # Decode the template once, each card works on a copy
+        self.template = Image.open(self.image_path)
+        self.template.load()
+
+        self.font = ImageFont.truetype(self.font_path, self.font_size)
+
+        # Width of the widest heading and of the colon never change between cards
+        draw = ImageDraw.Draw(self.template)
+        self.max_headings_width = max(
+            draw.textlength(heading, font=self.font) for heading in self.headings
+        )
+        self.colon_width = draw.textlength(":", font=self.font)
+
+        self.fingerprint = self._fingerprint(spec)
+
+        # Pre-rendered static text layers keyed by text position, least recently used first
+        self._static_layers = OrderedDict()
+        self._static_layers_lock = threading.Lock()
+
+    # Hash of everything that shapes a rendered card apart from its inputs
+    def _fingerprint(self, spec: dict) -> str:
+        sha = hashlib.sha256()
+        for path in (self.image_path, self.font_path):
+            with open(path, "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    sha.update(chunk)
+
+        # Paths only matter through the file contents hashed above
+        layout = {key: value for key, value in spec.items() if key != "image"}
+        layout["font"] = {"size": self.font_size}
+        layout["image_extension"] = c.IMAGE_EXTENSION
+        sha.update(json.dumps(layout, sort_keys=True).encode())
+
+        return sha.hexdigest()[:16]
+
+    def _current_mtimes(self) -> tuple[float, ...]:
+        paths = [self.image_path, self.font_path]
+        if self.spec_path:
+            paths.append(self.spec_path)
+        return tuple(os.path.getmtime(path) for path in paths)
+
+    # Whether the spec, template or font file changed on disk since compiling
+    def is_stale(self) -> bool:
+        return self._current_mtimes() != self.mtimes
+
+    # A fresh canvas for one card
+    def canvas(self) -> Image.Image:
+        return self.template.copy()
+
+    def colon_position(self, text_position: tuple[float, float]) -> tuple[float, float]:
+        return (
+            text_position[0] + self.max_headings_width + self.padding_heading,
+            text_position[1],
+        )
+
+    # Where the text block starts for these inputs, after applying the overflow rule
+    def place_text(
+        self, draw: ImageDraw.ImageDraw, values: list[str]
+    ) -> tuple[float, float]:
+        max_input_width = max(
+            draw.textlength(value, font=self.font) for value in values
+        )
+
+        total_width = (
+            self.max_headings_width
+            + self.padding_heading
+            + self.colon_width
+            + self.padding_input
+            + max_input_width
+        )
+
+        # Check if the text fits in the template if started from set position
+        width = self.template.size[0]
+        if self.overflow == "center" and total_width + self.text_position[0] > width:
+            return ((width - total_width) // 2, self.text_position[1])
+
+        return self.text_position
+
+    # Draw the headings and the colon column starting at text_position
+    def draw_static_text(
+        self, draw: ImageDraw.ImageDraw, text_position: tuple[float, float]
+    ):
+        draw.text(
+            text_position, "\n".join(self.headings), font=self.font, **self.text_style
+        )
+        draw.text(
+            self.colon_position(text_position),
+            "\n".join([":"] * len(self.headings)),
+            font=self.font,
+            **self.text_style,
+        )
+
+    # Template region covered by the static text, including its stroke
+    def _static_box(
+        self, draw: ImageDraw.ImageDraw, text_position: tuple[float, float]
+    ) -> tuple[int, int, int, int]:
+        bbox_kwargs = {
+            "font": self.font,
+            "stroke_width": self.text_style["stroke_width"],
+            "spacing": self.text_style["spacing"],
+        }
+        headings = draw.multiline_textbbox(
+            text_position, "\n".join(self.headings), **bbox_kwargs
+        )
+        colons = draw.multiline_textbbox(
+            self.colon_position(text_position),
+            "\n".join([":"] * len(self.headings)),
+            **bbox_kwargs,
+        )
+
+        return (
+            max(math.floor(min(headings[0], colons[0])), 0),
+            max(math.floor(min(headings[1], colons[1])), 0),
+            min(math.ceil(max(headings[2], colons[2])), self.template.size[0]),
+            min(math.ceil(max(headings[3], colons[3])), self.template.size[1]),
+        )
+
+    # Render the template region under the static text with the text already drawn
+    def _render_static_layer(
+        self, text_position: tuple[float, float]
+    ) -> tuple[Image.Image, tuple[int, int]] | None:
+        canvas = self.canvas()
+        draw = ImageDraw.Draw(canvas)
+        left, top, right, bottom = self._static_box(draw, text_position)
+
+        # The layer replaces template pixels, so it must not cover the photo
+        if (
+            left < self.photo_box[2]
+            and self.photo_box[0] < right
+            and top < self.photo_box[3]
+            and self.photo_box[1] < bottom
+        ):
+            return None
+
+        self.draw_static_text(draw, text_position)
+        return canvas.crop((left, top, right, bottom)), (left, top)
+
+    # Get the pre-rendered static text layer and its paste position,
+    # or None when it has to be drawn directly
+    def static_layer(
+        self, text_position: tuple[float, float]
+    ) -> tuple[Image.Image, tuple[int, int]] | None:
+        key = tuple(text_position)
+
+        with self._static_layers_lock:
+            if key in self._static_layers:
+                self._static_layers.move_to_end(key)
+                return self._static_layers[key]
+
+        layer = self._render_static_layer(key)
+
+        with self._static_layers_lock:
+            self._static_layers[key] = layer
+            while len(self._static_layers) > c.STATIC_LAYER_CACHE_SIZE:
+                self._static_layers.popitem(last=False)
+
+        return layer
+
+    # A fresh canvas with the photo pasted into its box
+    def composite(self, photo: Image.Image) -> Image.Image:
+        card = self.canvas()
+
+        # Resize the image to fit the template and paste it
+        card.paste(photo.resize(self.photo_size), self.photo_position)
+
+        return card
+
+    # Draw the headings, colons and the text for each field onto a card
+    def draw_text(self, card: Image.Image, values: dict[str, str]):
+        draw = ImageDraw.Draw(card)
+        inputs = [values.get(key, "") for key in self.field_keys]
+        text_position = self.place_text(draw, inputs)
+
+        # Add the headings and colons from the cached layer when possible
+        static_layer = self.static_layer(text_position)
+        if static_layer is None:
+            self.draw_static_text(draw, text_position)
+        else:
+            card.paste(*static_layer)
+
+        input_position = (
+            self.colon_position(text_position)[0]
+            + self.colon_width
+            + self.padding_input,
+            text_position[1],
+        )
+
+        # Add the inputs
+        draw.text(input_position, "\n".join(inputs), font=self.font, **self.text_style)
+
+    # Render a card from a square photo and the text for each field
+    def render(self, photo: Image.Image, values: dict[str, str]) -> Image.Image:
+        card = self.composite(photo)
+        self.draw_text(card, values)
+        return card
+
+
+_plans: dict[str, LayoutPlan] = {}
+_plans_lock = threading.Lock()
+
+
+# Get the compiled plan for a template, recompiling it when its files changed.
+# Every template used stays loaded side by side. Relative spec paths are
+# relative to the project directory
+def get_layout_plan(template: str | None = None) -> LayoutPlan:
+    template = template or DEFAULT_TEMPLATE
+
+    with _plans_lock:
+        plan = _plans.get(template)
+        if plan is None or plan.is_stale():
+            if template == DEFAULT_TEMPLATE:
+                plan = LayoutPlan(default_template_spec())
+            else:
+                spec_path = os.path.join(c.BASE_DIR, template)
+                try:
+                    plan = LayoutPlan(load_template_spec(spec_path), spec_path)
+                except (KeyError, TypeError, IndexError) as e:
+                    # Values of the wrong shape, such as a position that isn't a pair
+                    raise ValueError(
+                        f"{spec_path}: invalid spec ({type(e).__name__}: {e})"
+                    ) from e
+            _plans[template] = plan
+
+        return plan
+
+
+# Short name of a template for card filenames, the name of its spec file,
+# or "" for the default template
+def template_tag(template: str | None) -> str:
+    if not template or template == DEFAULT_TEMPLATE:
+        return ""
+    return os.path.splitext(os.path.basename(template))[0]
+
+
+# The default template and every spec file in the templates directory,
+# relative to the project directory so they stay valid if it moves
+def available_templates() -> list[str]:
+    templates = [DEFAULT_TEMPLATE]
+    if os.path.isdir(c.TEMPLATES_DIR):
+        templates += [
+            os.path.relpath(os.path.join(c.TEMPLATES_DIR, filename), c.BASE_DIR)
+            for filename in sorted(os.listdir(c.TEMPLATES_DIR))
+            if filename.lower().endswith((".json", ".toml"))
+        ]
+    return templates
@@ -1,52 +1,103 @@
+import math
 import os
 import sys
+import tempfile
+import time
 from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 
-import gradio as gr
 from PIL import Image
 from tqdm import tqdm
 
+import card_index
+import card_store
 import constants as c
+import face_store
 import id_creator
+import jobs
+import layout
+import metrics
 import pdf_gen
+import single_flight
+import thumbnails
+
+# Background jobs for long-running operations, shared by every session
+job_manager = jobs.JobManager(c.JOB_CONCURRENCY)
+# Recent PDFs answering repeated prints, see print_pdf in build_demo
+print_flight = single_flight.SingleFlight("print")
+
+metrics.register_gauge(
+    "id_card_job_queue_depth",
+    "Background jobs waiting for a free slot",
+    job_manager.queue_depth,
+)
+metrics.register_gauge(
+    "id_card_jobs_running",
+    "Background jobs running",
+    lambda: sum(job.status == "running" for job in job_manager.list()),
+)
+metrics.register_gauge(
+    "id_card_jobs_shared_total",
+    "Jobs that followed an identical job instead of running again",
+    lambda: job_manager.shared,
+    "counter",
+)
+
+
+# Gets one page of ID cards matching the search query from the card index
+def get_id_card_details(query: str = "", page: int = 1):
+    import gradio as gr
+
+    total = card_index.index.count(query)
+    pages = max(1, math.ceil(total / c.LIST_PAGE_SIZE))
+    page = min(max(int(page or 1), 1), pages)
+
+    id_cards_df = card_index.index.search(
+        query, offset=(page - 1) * c.LIST_PAGE_SIZE, limit=c.LIST_PAGE_SIZE
+    )
 
-
-# Extracts details from output image filenames into a dataframe
-def get_id_card_details():
-    id_cards_df = []
-    # Skip non image files if any
-    file_paths = sorted(
-        [path for path in os.listdir(c.IMAGES_OUTPUT_PATH) if path.endswith(".png")]
+    # Thumbnails only for this page, made on first view for cards that lack one
+    gallery = []
+    for card_id, name, _, _, filename in id_cards_df:
+        card_path = card_store.get_card_store().path(filename)
+        if os.path.exists(card_path):
+            gallery.append((thumbnails.get_thumbnail(card_path), f"{card_id}: {name}"))
+
+    return (
+        gr.update(value=page, maximum=pages),
+        id_cards_df,
+        f"{total} card(s), page {page} of {pages}",
+        gallery,
     )
-    for idx, fp in enumerate(file_paths, start=1):
-        # Extract details from the filename
-        parts = fp.replace("ID_Card_", "").replace(".png", "").split("_")
-        
-        # name _ mobile _ post
-        if id_creator.format_phone_number(parts[3])[0]:
-            # Name has middle name
-            name = parts[0] + " " + parts[1] + " " + parts[2]
-            mobile = parts[3]
-            post = " ".join(parts[4:])
-        else:
-            # Name doesn't have middle name
-            name = parts[0] + " " + parts[1]
-            mobile = parts[2]
-            post = " ".join(parts[3:])
-
-        id_cards_df.append([idx, name, mobile, post, fp])
-
-    return gr.update(maximum=len(id_cards_df)), id_cards_df
-
-
-# Loads the face image from the specified ID card
-def display_id_photo(filename: str):
-    image_path = os.path.join(c.IMAGES_OUTPUT_PATH, filename)
-
-    # Load image and crop the face section
+
+
+# Remove printed PDFs past PRINTS_MAX_AGE_SECONDS, and the oldest beyond keep
+def prune_prints(keep: int = c.PRINTS_KEEP):
+    with os.scandir(c.PRINTS_DIR) as entries:
+        prints = sorted(
+            (entry.stat().st_mtime, entry.path)
+            for entry in entries
+            if entry.is_file() and entry.name.endswith(".pdf")
+        )
+
+    expired = time.time() - c.PRINTS_MAX_AGE_SECONDS
+    for index, (modified, path) in enumerate(prints):
+        if modified < expired or index < len(prints) - keep:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# Crops the photo back out of a rendered ID card
+def crop_card_photo(card: dict) -> Image.Image:
+    image_path = card_store.get_card_store().path(card["filename"])
+
+    # The photo is where the card was rendered, even if the layout changed since
     full_image = Image.open(image_path)
-    face_image = full_image.crop(
-        (
+    return full_image.crop(
+        card["photo_box"]
+        or (
             c.PICTURE_POSITION[0],
             c.PICTURE_POSITION[1],
             c.PICTURE_POSITION[0] + c.PICTURE_SIZE[0],
@@ -54,276 +105,557 @@ def display_id_photo(filename: str):
         )
     )
 
-    return face_image
 
+# Loads the face image of the specified ID card, from the face store when possible
+def display_id_photo(card: dict):
+    face_path = face_store.face_path(card["face_key"]) if card["face_key"] else None
+    if face_path and os.path.exists(face_path):
+        # Gradio serves the stored file directly, nothing to decode here
+        return face_path
+
+    return crop_card_photo(card)
 
-# Deletes the specified ID card file
-def delete_id_card(sl_num: int, id_cards_df: list[list[int | str]]):
-    # Extract the filename and remove the entry from the dataframe
-    filename = id_cards_df[sl_num - 1][4]
-    id_cards_df.pop(sl_num - 1)
 
-    # Update the sl_num of the remaining entries
-    for i in range(sl_num - 1, len(id_cards_df)):
-        id_cards_df[i][0] -= 1
+# Deletes the specified ID card file and its index entry
+def delete_id_card(card_id: int):
+    card = card_index.index.get(card_id)
+    if card is None:
+        return f"No ID card with ID {card_id}."
 
-    file_path = os.path.join(c.IMAGES_OUTPUT_PATH, filename)
+    card_index.index.remove(card_id)
+    store = card_store.get_card_store()
+
+    thumbnails.delete_thumbnail(store.path(card["filename"]))
 
     # Delete the file if it exists
-    if os.path.exists(file_path):
-        os.remove(file_path)
-        return id_cards_df, f"Deleted {filename} successfully!"
-    return id_cards_df, f"File {filename} does not exist."
-
-
-def regenerate_all_id_cards():
-    _, id_cards_df = get_id_card_details()
-
-    def process_id_card(id_card: list[int | str]):
-        image_path = os.path.join(c.IMAGES_OUTPUT_PATH, id_card[4])
-        full_image = Image.open(image_path)
-        face_image = full_image.crop(
-            (
-                c.PICTURE_POSITION[0],
-                c.PICTURE_POSITION[1],
-                c.PICTURE_POSITION[0] + c.PICTURE_SIZE[0],
-                c.PICTURE_POSITION[1] + c.PICTURE_SIZE[1],
-            )
+    if store.delete(card["filename"]):
+        return f"Deleted {card['filename']} successfully!"
+    return f"File {card['filename']} does not exist."
+
+
+# Re-renders cards made with an outdated template, font or layout, or all with force.
+# on_progress(done, total) is called as each card finishes
+def regenerate_all_id_cards(
+    force: bool = False, on_progress: Callable[[int, int], None] | None = None
+):
+    all_cards = card_index.index.cards()
+
+    # Compare each card against the current fingerprint of its own template
+    fingerprints = {}
+    for card in all_cards:
+        template = card["template"] or layout.DEFAULT_TEMPLATE
+        if template not in fingerprints:
+            try:
+                fingerprints[template] = layout.get_layout_plan(template).fingerprint
+            except (OSError, ValueError):
+                # Template is gone, regenerate these cards with the default one
+                fingerprints[template] = None
+
+    cards = [
+        card
+        for card in all_cards
+        if force
+        or card["fingerprint"]
+        != fingerprints[card["template"] or layout.DEFAULT_TEMPLATE]
+    ]
+    skipped = len(all_cards) - len(cards)
+
+    def process_id_card(card: dict):
+        face_image = face_store.load_face(card["face_key"]) or crop_card_photo(card)
+
+        template = card["template"] or layout.DEFAULT_TEMPLATE
+        if fingerprints[template] is None:
+            template = layout.DEFAULT_TEMPLATE
+
+        output_path, _ = id_creator.generate_id_card(
+            face_image,
+            0.5,
+            1,
+            True,
+            card["name"],
+            card["phone"],
+            card["post"],
+            template,
         )
 
-        id_creator.generate_id_card(
-            face_image, 0.5, 1, True, id_card[1], id_card[2], id_card[3]
-        )
+        # Made under another filename, as when its template is gone, replaces it
+        if output_path and os.path.basename(output_path) != card["filename"]:
+            delete_id_card(card["id"])
+
+    with ThreadPoolExecutor(max_workers=c.JOB_WORKERS) as executor:
+        futures = [executor.submit(process_id_card, card) for card in cards]
+        try:
+            # Wait for all tasks to complete
+            for done, future in enumerate(
+                tqdm(futures, desc="Regenerating images", unit="image(s) "), start=1
+            ):
+                future.result()
+                if on_progress:
+                    on_progress(done, len(futures))
+        except BaseException:
+            # Don't start the remaining cards when cancelled or failed
+            for future in futures:
+                future.cancel()
+            raise
+
+    return f"Regenerated {len(cards)} ID card(s), skipped {skipped} up to date."
 
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_id_card, id_card) for id_card in id_cards_df]
-        # Wait for all tasks to complete
-        for future in tqdm(futures, desc="Regenerating images", unit="image(s) "):
-            future.result()
 
-    return "All ID cards regenerated successfully!"
+# * Gradio Interface
+# Build the web interface, gradio is only imported here so tools can import this module
+def build_demo():
+    import gradio as gr
+
+    with gr.Blocks(title="ID Card Station") as demo:
+        with gr.Tabs() as tabs:
+
+            with gr.TabItem("Generate ID Card", id=0):
+                gr.Markdown("# ID Card Generator 📇")
+
+                with gr.Row():
+                    with gr.Column():
+                        # Input for person's photo
+                        person_image = gr.Image(
+                            type="filepath",
+                            label="Upload Photo with Face",
+                            height=300,
+                            show_fullscreen_button=False,
+                        )
 
+                        # Input fields for face detection
+                        with gr.Row():
+                            target_face_size = gr.Slider(
+                                label="Target Face Size",
+                                minimum=0.3,
+                                maximum=0.7,
+                                value=0.5,
+                                step=0.05,
+                            )
+                            face_num = gr.Radio(
+                                label="Face Number (higher = inaccurate)",
+                                choices=[1, 2, 3],
+                                value=1,
+                            )
+                            force_image = gr.Checkbox(
+                                label="Force Image",
+                                value=False,
+                            )
+
+                        # Card design to render with
+                        template_choice = gr.Dropdown(
+                            label="Template",
+                            choices=layout.available_templates(),
+                            value=layout.DEFAULT_TEMPLATE,
+                        )
 
-def get_filename_from_df(sl_num):
-    return get_id_card_details()[1][sl_num - 1][4]
+                        # Input fields for details
+                        name = gr.Textbox(label="Full Name", lines=1)
+                        phone = gr.Textbox(
+                            label="Phone Number (10 digits)",
+                            placeholder="# " * 10,
+                            lines=1,
+                        )
+                        post = gr.Textbox(label="Post", value="Member", lines=1)
 
+                        # Generate button
+                        generate_button = gr.Button(
+                            value="Generate ID Card",
+                            variant="primary",
+                            size="lg",
+                        )
 
-# * Gradio Interface
-with gr.Blocks(title="ID Card Station") as demo:
-    with gr.Tabs() as tabs:
+                    # Output and status alerts
+                    with gr.Column():
+                        result_image = gr.Image(
+                            label="Generated ID Card",
+                            height=600,
+                            show_fullscreen_button=False,
+                        )
+                        alert = gr.Textbox(
+                            placeholder="Current Status or Errors will be shown here.",
+                            label="Status / Errors",
+                            interactive=False,
+                        )
 
-        with gr.TabItem("Generate ID Card", id=0):
-            gr.Markdown("# ID Card Generator 📇")
+                    # Function to the id generator with initial checks
+                    def handle_generate(
+                        person_image: gr.Image,
+                        target_face_size: float,
+                        face_num: int,
+                        force_image: bool,
+                        name: str,
+                        phone: str,
+                        post: str,
+                        template: str,
+                    ):
+
+                        if person_image is None:
+                            return None, "Please upload the person's photo."
+                        elif name is None or phone is None or post is None:
+                            return None, "Please fill in all the required fields."
+
+                        output, message = id_creator.generate_id_card(
+                            person_image,
+                            target_face_size,
+                            face_num,
+                            force_image,
+                            name,
+                            phone,
+                            post,
+                            template,
+                        )
+                        if output:
+                            return output, message
+                        else:
+                            return None, message
+
+                    # Connect the function to the interface
+                    generate_button.click(
+                        fn=handle_generate,
+                        inputs=[
+                            person_image,
+                            target_face_size,
+                            face_num,
+                            force_image,
+                            name,
+                            phone,
+                            post,
+                            template_choice,
+                        ],
+                        outputs=[result_image, alert],
+                    )
 
-            with gr.Row():
-                with gr.Column():
-                    # Input for person's photo
-                    person_image = gr.Image(
-                        type="filepath",
-                        label="Upload Photo with Face",
-                        height=300,
-                        show_fullscreen_button=False,
+            with gr.TabItem("ID Card List", id=1):
+                with gr.Row():
+                    search_box = gr.Textbox(
+                        label="Search", placeholder="Name, mobile or post", scale=3
                     )
+                    page_num = gr.Number(
+                        label="Page", value=1, minimum=1, precision=0, scale=1
+                    )
+                    list_status = gr.Markdown()
 
-                    # Input fields for face detection
-                    with gr.Row():
-                        target_face_size = gr.Slider(
-                            label="Target Face Size",
-                            minimum=0.3,
-                            maximum=0.7,
-                            value=0.5,
-                            step=0.05,
+                with gr.Row():
+                    list_view = gr.DataFrame(
+                        headers=["ID", "Name", "Mobile", "Post", "Filename"],
+                        type="array",
+                        interactive=False,
+                    )
+
+                with gr.Row():
+                    card_gallery = gr.Gallery(
+                        label="Cards on this page",
+                        columns=8,
+                        height=320,
+                        allow_preview=False,
+                    )
+
+                # List View Section
+                with gr.Row():
+                    with gr.Column():
+                        refresh_button = gr.Button(
+                            value="Refresh List", variant="secondary"
                         )
-                        face_num = gr.Radio(
-                            label="Face Number (higher = inaccurate)",
-                            choices=[1, 2, 3],
+                        see_photo_button = gr.Button(
+                            value="See Photo", variant="secondary"
+                        )
+                    with gr.Column():
+                        id_num_selected = gr.Number(
+                            label="Select ID of Entry to View / Delete / Edit",
                             value=1,
+                            minimum=1,
+                            precision=0,
+                            interactive=True,
+                        )
+
+                # Delete/Edit Buttons
+                with gr.Row():
+                    with gr.Column():
+                        photo_preview = gr.Image(
+                            height=400, show_fullscreen_button=False, interactive=False
+                        )
+                    with gr.Column():
+                        edit_button = gr.Button(
+                            value="Edit Selected as New", variant="primary"
+                        )
+                        delete_button = gr.Button(
+                            value="Delete Selected from Saved", variant="stop"
                         )
-                        force_image = gr.Checkbox(
-                            label="Force Image",
-                            value=False,
+                        alert2 = gr.Textbox(
+                            placeholder="Current Status or Errors will be shown here.",
+                            label="Status / Errors",
+                            interactive=False,
                         )
 
-                    # Input fields for details
-                    name = gr.Textbox(label="Full Name", lines=1)
-                    phone = gr.Textbox(
-                        label="Phone Number (10 digits)", placeholder="# " * 10, lines=1
-                    )
-                    post = gr.Textbox(label="Post", value="Member", lines=1)
+                # Bind Functions
+                list_inputs = [search_box, page_num]
+                list_outputs = [page_num, list_view, list_status, card_gallery]
+
+                refresh_button.click(
+                    fn=get_id_card_details, inputs=list_inputs, outputs=list_outputs
+                )
+                search_box.submit(
+                    fn=lambda query: get_id_card_details(query, 1),
+                    inputs=search_box,
+                    outputs=list_outputs,
+                )
+                page_num.submit(
+                    fn=get_id_card_details, inputs=list_inputs, outputs=list_outputs
+                )
+                delete_button.click(
+                    fn=delete_id_card,
+                    inputs=id_num_selected,
+                    outputs=alert2,
+                ).then(fn=get_id_card_details, inputs=list_inputs, outputs=list_outputs)
+
+                def see_photo(card_id):
+                    card = card_index.index.get(card_id)
+                    return display_id_photo(card) if card else None
+
+                see_photo_button.click(
+                    fn=see_photo,
+                    inputs=id_num_selected,
+                    outputs=photo_preview,
+                )
+
+                # Clicking a thumbnail selects its card, read from the caption
+                # since cards missing their file have no thumbnail in the list
+                def select_from_gallery(evt: gr.SelectData):
+                    card_id = int(evt.value["caption"].split(":", 1)[0])
+                    return card_id, see_photo(card_id)
 
-                    # Generate button
-                    generate_button = gr.Button(
-                        value="Generate ID Card",
-                        variant="primary",
-                        size="lg",
+                card_gallery.select(
+                    fn=select_from_gallery,
+                    outputs=[id_num_selected, photo_preview],
+                )
+
+                def edit(card_id):
+                    card = card_index.index.get(card_id)
+                    if card is None:
+                        return (gr.update(),) * 5
+                    return (
+                        card["name"],
+                        card["phone"],
+                        card["post"],
+                        display_id_photo(card),
+                        gr.Tabs(selected=0),
                     )
 
-                # Output and status alerts
+                edit_button.click(
+                    fn=edit,
+                    inputs=id_num_selected,
+                    outputs=[name, phone, post, person_image, tabs],
+                )
+
+            with gr.TabItem("ID Card PDF Printer", id=2):
                 with gr.Column():
-                    result_image = gr.Image(
-                        label="Generated ID Card",
-                        height=600,
-                        show_fullscreen_button=False,
+                    with gr.Row():
+                        regenerate_all_button = gr.Button(
+                            value="Regenerate All ID Cards",
+                            variant="secondary",
+                            scale=3,
+                        )
+                        force_rebuild = gr.Checkbox(
+                            label="Force full rebuild", value=False, scale=1
+                        )
+                    print_button = gr.Button(
+                        value="Print ID Cards to PDF", variant="primary"
                     )
-                    alert = gr.Textbox(
-                        placeholder="Current Status or Errors will be shown here.",
-                        label="Status / Errors",
+                    status = gr.Textbox(
+                        label="Status",
+                        value="Ready to Print",
                         interactive=False,
+                        lines=1,
                     )
-
-                # Function to the id generator with initial checks
-                def handle_generate(
-                    person_image: gr.Image,
-                    target_face_size: float,
-                    face_num: int,
-                    force_image: bool,
-                    name: str,
-                    phone: str,
-                    post: str,
-                ):
-
-                    if person_image is None:
-                        return None, "Please upload the person's photo."
-                    elif name is None or phone is None or post is None:
-                        return None, "Please fill in all the required fields."
-
-                    output, message = id_creator.generate_id_card(
-                        person_image,
-                        target_face_size,
-                        face_num,
-                        force_image,
-                        name,
-                        phone,
-                        post,
+                    download_btn = gr.DownloadButton(
+                        label="Download PDF",
+                        value=None,
+                        variant="secondary",
                     )
-                    if output:
-                        return output, message
-                    else:
-                        return None, message
-
-                # Connect the function to the interface
-                generate_button.click(
-                    fn=handle_generate,
-                    inputs=[
-                        person_image,
-                        target_face_size,
-                        face_num,
-                        force_image,
-                        name,
-                        phone,
-                        post,
-                    ],
-                    outputs=[result_image, alert],
-                )
 
-        with gr.TabItem("ID Card List", id=1):
-            with gr.Row():
-                list_view = gr.DataFrame(
-                    headers=["Sl No", "Name", "Mobile", "Post", "Filename"],
+                # Background jobs of every operator
+                jobs_view = gr.DataFrame(
+                    headers=[
+                        "Job",
+                        "Name",
+                        "Status",
+                        "Progress",
+                        "Queued",
+                        "Ran",
+                        "Message",
+                    ],
                     interactive=False,
                 )
-
-            # List View Section
-            with gr.Row():
-                with gr.Column():
-                    refresh_button = gr.Button(
-                        value="Refresh List", variant="secondary"
+                with gr.Row():
+                    cancel_job_id = gr.Textbox(
+                        label="Job ID to Cancel", lines=1, scale=3
                     )
-                    see_photo_button = gr.Button(value="See Photo", variant="secondary")
-                with gr.Column():
-                    id_num_selected = gr.Number(
-                        label="Select ID of Entry to View / Delete / Edit",
-                        value=1,
-                        minimum=1,
-                        maximum=len(get_id_card_details()[1]),
-                        interactive=True,
+                    cancel_job_button = gr.Button(
+                        value="Cancel Job", variant="stop", scale=1
                     )
 
-            # Delete/Edit Buttons
-            with gr.Row():
-                with gr.Column():
-                    photo_preview = gr.Image(
-                        height=400, show_fullscreen_button=False, interactive=False
+                # Print job started from this session, to offer its PDF for download
+                print_job_id = gr.State(None)
+                jobs_timer = gr.Timer(value=1.0)
+
+                def start_regenerate(force):
+                    job = job_manager.submit(
+                        "Regenerate ID cards", regenerate_all_id_cards, force
                     )
-                with gr.Column():
-                    edit_button = gr.Button(
-                        value="Edit Selected as New", variant="primary"
+                    return f"Queued job {job.id} to regenerate ID cards."
+
+                # Each print gets its own file so concurrent prints never clobber
+                # each other. It is named .part until finished, so pruning the
+                # old ones to make room never removes a print being written
+                def render_to_file(on_progress):
+                    c.ensure_directories()
+                    prune_prints(c.PRINTS_KEEP - 1)
+
+                    fd, part_path = tempfile.mkstemp(
+                        prefix="ID_Cards_", suffix=".pdf.part", dir=c.PRINTS_DIR
                     )
-                    delete_button = gr.Button(
-                        value="Delete Selected from Saved", variant="stop"
+                    try:
+                        with os.fdopen(fd, "wb") as pdf_file:
+                            pdf_gen.render_pdf(pdf_file, on_progress=on_progress)
+                    except BaseException:
+                        os.remove(part_path)
+                        raise
+
+                    pdf_path = part_path.removesuffix(".part")
+                    os.replace(part_path, pdf_path)
+                    return pdf_path
+
+                # A print just like one that finished moments ago gets its PDF.
+                # Keyed when it runs, as cards can change while it is queued
+                def print_pdf(on_progress):
+                    key = pdf_gen.print_key()
+                    found, pdf_path = print_flight.recent(key, valid=os.path.exists)
+                    if not found:
+                        pdf_path = render_to_file(on_progress)
+                        print_flight.remember(key, pdf_path)
+                    return pdf_path
+
+                # Prints of the same cards, such as several stations printing at
+                # once, follow the print job already queued or running
+                def start_print():
+                    job = job_manager.submit_shared(
+                        ("print", pdf_gen.print_key()), "Print ID cards", print_pdf
                     )
-                    alert2 = gr.Textbox(
-                        placeholder="Current Status or Errors will be shown here.",
-                        label="Status / Errors",
-                        interactive=False,
+                    return f"Queued job {job.id} to print ID cards.", job.id
+
+                def poll_jobs(job_id):
+                    rows = [job.as_row() for job in job_manager.list()]
+
+                    job = job_manager.get(job_id) if job_id else None
+                    if job is None or not job.finished:
+                        return rows, gr.update(), gr.update(), job_id
+
+                    # The print job of this session finished, stop tracking it
+                    if job.status == "done":
+                        return (
+                            rows,
+                            "PDF Created Successfully!",
+                            gr.update(value=job.result, variant="primary"),
+                            None,
+                        )
+                    return (
+                        rows,
+                        f"Print job {job.status}: {job.message}",
+                        gr.update(),
+                        None,
                     )
 
-            # Bind Functions
-            refresh_button.click(
-                fn=lambda: get_id_card_details(), outputs=[id_num_selected, list_view]
-            )
-            delete_button.click(
-                fn=lambda sl_num: delete_id_card(sl_num, get_id_card_details()[1]),
-                inputs=id_num_selected,
-                outputs=[list_view, alert2],
-            )
-            see_photo_button.click(
-                fn=lambda sl_num: display_id_photo(get_filename_from_df(sl_num)),
-                inputs=id_num_selected,
-                outputs=photo_preview,
-            )
-
-            def edit(sl_num):
-                id_cards_df = get_id_card_details()[1]
-                return (
-                    *id_cards_df[sl_num - 1][1:4],
-                    display_id_photo(get_filename_from_df(sl_num)),
-                    gr.Tabs(selected=0),
+                regenerate_all_button.click(
+                    fn=start_regenerate, inputs=force_rebuild, outputs=status
                 )
-
-            edit_button.click(
-                fn=edit,
-                inputs=id_num_selected,
-                outputs=[name, phone, post, person_image, tabs],
-            )
-
-        with gr.TabItem("ID Card PDF Printer", id=2):
-            with gr.Column():
-                regenerate_all_button = gr.Button(
-                    value="Regenerate All ID Cards", variant="secondary"
+                download_btn.click(
+                    fn=lambda: gr.update(value=None, variant="secondary"),
+                    inputs=[],
+                    outputs=[download_btn],
                 )
-                print_button = gr.Button(
-                    value="Print ID Cards to PDF", variant="primary"
+                print_button.click(fn=start_print, outputs=[status, print_job_id])
+                cancel_job_button.click(
+                    fn=lambda job_id: job_manager.cancel(job_id.strip()),
+                    inputs=cancel_job_id,
+                    outputs=status,
                 )
-                status = gr.Textbox(
-                    label="Status", value="Ready to Print", interactive=False, lines=1
+                jobs_timer.tick(
+                    fn=poll_jobs,
+                    inputs=print_job_id,
+                    outputs=[jobs_view, status, download_btn, print_job_id],
+                )
+
+            with gr.TabItem("Stats", id=3):
+                with gr.Row():
+                    refresh_stats_button = gr.Button(
+                        value="Refresh", variant="secondary"
+                    )
+                    reset_stats_button = gr.Button(value="Reset", variant="stop")
+
+                # Timings since start or the last reset, by stage and by request
+                stats_view = gr.DataFrame(
+                    headers=[
+                        "Kind",
+                        "Name",
+                        "Count",
+                        "Mean (ms)",
+                        "Max (ms)",
+                        "Total (s)",
+                    ],
+                    interactive=False,
                 )
-                download_btn = gr.DownloadButton(
-                    label="Download PDF",
-                    value=None,
-                    variant="secondary",
+                gauges_view = gr.DataFrame(
+                    headers=["Metric", "Value"], interactive=False
                 )
+                prometheus_view = gr.Code(label="Prometheus metrics", interactive=False)
 
-            regenerate_all_button.click(fn=regenerate_all_id_cards, outputs=status)
-            download_btn.click(
-                fn=lambda: gr.update(value=None, variant="secondary"),
-                inputs=[],
-                outputs=[download_btn],
-            )
+                def refresh_stats():
+                    return (
+                        metrics.stats_rows(),
+                        metrics.gauge_rows(),
+                        metrics.prometheus_text(),
+                    )
+
+                def reset_stats():
+                    metrics.reset()
+                    return refresh_stats()
+
+                refresh_stats_button.click(
+                    fn=refresh_stats,
+                    outputs=[stats_view, gauges_view, prometheus_view],
+                )
+                reset_stats_button.click(
+                    fn=reset_stats,
+                    outputs=[stats_view, gauges_view, prometheus_view],
+                )
 
-            print_button.click(
-                fn=lambda: (
-                    pdf_gen.render_pdf(),
-                    gr.update(value=c.OUTPUT_PDF, variant="primary"),
-                ),
-                outputs=[status, download_btn],
-            )
+    return demo
 
 
 if __name__ == "__main__":
+    c.ensure_directories()
+
+    # Move cards saved flat in the output directory into the card store
+    store = card_store.get_card_store()
+    moved = card_store.migrate(c.IMAGES_DIR, store)
+    if moved:
+        card_index.index.update_output_paths(moved)
+        print(f" Moved {len(moved)} ID card(s) into the card store.")
+
+    # Index cards made before the card index existed, or moved in without an entry
+    if (moved or len(card_index.index) == 0) and store.filenames():
+        indexed, _ = card_index.index.rebuild_from_disk(store)
+        print(f" Indexed {indexed} existing ID card(s).")
+
+    if c.METRICS_PORT:
+        metrics.serve(c.METRICS_PORT)
+        print(f" Metrics at http://localhost:{c.METRICS_PORT}/metrics")
+
+    demo = build_demo()
+
     print(" Ctrl+Click the URL: http://localhost:7860")
     
-    _, local_url, _ = demo.launch(share=False, inbrowser=True, quiet=True, server_port=7860)
+    _, local_url, _ = demo.launch(share=False, inbrowser=True, quiet=True, server_port=7860, allowed_paths=[c.IMAGES_DIR, c.THUMBNAILS_DIR, c.FACES_DIR, c.PRINTS_DIR])
 
     print(" [!] Webserver is terminated.")
 
@@ -0,0 +1,239 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+import constants as c
+
+logger = logging.getLogger(__name__)
+
+# Whether stage timings are recorded, when off every hook is a shared no-op
+enabled = c.METRICS_ENABLED
+
+_NULL = nullcontext()
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Histogram:
+    """Count, sum, maximum and bucket counts of observed durations."""
+
+    def __init__(self, buckets: tuple[float, ...] = c.METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        # Only the first bucket that fits, _histogram_lines makes them cumulative
+        index = bisect.bisect_left(self.buckets, seconds)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+
+_stages: dict[str, Histogram] = {}
+_requests: dict[str, Histogram] = {}
+_slow_requests: dict[str, int] = {}
+
+# Extra values read when the metrics are exported: name -> (type, help, read)
+_gauges: dict[str, tuple[str, str, Callable[[], float]]] = {}
+
+
+def _observe(histograms: dict[str, Histogram], name: str, seconds: float):
+    with _lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+
+class _Stage:
+    """Times one stage into the totals and the breakdown of the current request."""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        _observe(_stages, self.name, seconds)
+
+        breakdown = getattr(_local, "breakdown", None)
+        if breakdown is not None:
+            breakdown[self.name] = breakdown.get(self.name, 0.0) + seconds
+
+
+class _Request:
+    """Times a whole request and logs its stage breakdown when it is slow."""
+
+    __slots__ = ("name", "start", "outer")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.outer = getattr(_local, "breakdown", None)
+        _local.breakdown = {}
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        breakdown, _local.breakdown = _local.breakdown, self.outer
+        _observe(_requests, self.name, seconds)
+
+        if seconds >= c.SLOW_REQUEST_SECONDS:
+            with _lock:
+                _slow_requests[self.name] = _slow_requests.get(self.name, 0) + 1
+            stages = ", ".join(
+                f"{stage_name} {stage_seconds:.3f}s"
+                for stage_name, stage_seconds in sorted(
+                    breakdown.items(), key=lambda item: item[1], reverse=True
+                )
+            )
+            logger.warning(
+                "Slow %s took %.3fs: %s", self.name, seconds, stages or "no stages"
+            )
+
+
+# Time a stage of the current request: with metrics.stage("detect"): ...
+def stage(name: str):
+    return _Stage(name) if enabled else _NULL
+
+
+# Time a whole request, collecting the stages run inside it
+def request(name: str):
+    return _Request(name) if enabled else _NULL
+
+
+# Decorator timing every call of a function as a request
+def timed_request(name: str):
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with _Request(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Export a value read on demand, such as a cache hit count or a queue depth
+def register_gauge(
+    name: str, help_text: str, read: Callable[[], float], metric_type="gauge"
+):
+    _gauges[name] = (metric_type, help_text, read)
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _requests.clear()
+        _slow_requests.clear()
+
+
+def _histogram_lines(
+    metric: str, label: str, histograms: dict[str, Histogram]
+) -> list[str]:
+    lines = []
+    for name, histogram in sorted(histograms.items()):
+        labels = f'{label}="{name}"'
+        cumulative = 0
+        for bucket, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{{labels},le="{bucket}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f"{metric}_sum{{{labels}}} {histogram.sum:.6f}")
+        lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+# All metrics in the Prometheus text exposition format
+def prometheus_text() -> str:
+    with _lock:
+        lines = [
+            "# HELP id_card_stage_seconds Time spent in each pipeline stage",
+            "# TYPE id_card_stage_seconds histogram",
+            *_histogram_lines("id_card_stage_seconds", "stage", _stages),
+            "# HELP id_card_request_seconds Time spent in each kind of request",
+            "# TYPE id_card_request_seconds histogram",
+            *_histogram_lines("id_card_request_seconds", "request", _requests),
+            "# HELP id_card_slow_requests_total Requests logged as slow",
+            "# TYPE id_card_slow_requests_total counter",
+            *[
+                f'id_card_slow_requests_total{{request="{name}"}} {count}'
+                for name, count in sorted(_slow_requests.items())
+            ],
+        ]
+
+    for name, (metric_type, help_text, read) in sorted(_gauges.items()):
+        lines += [
+            f"# HELP {name} {help_text}",
+            f"# TYPE {name} {metric_type}",
+            f"{name} {read()}",
+        ]
+
+    return "\n".join(lines) + "\n"
+
+
+# One row per stage and request for the stats tab
+def stats_rows() -> list[list]:
+    with _lock:
+        histograms = [("stage", name, h) for name, h in sorted(_stages.items())] + [
+            ("request", name, h) for name, h in sorted(_requests.items())
+        ]
+        return [
+            [
+                kind,
+                name,
+                histogram.count,
+                round(histogram.sum / histogram.count * 1000, 1),
+                round(histogram.max * 1000, 1),
+                round(histogram.sum, 2),
+            ]
+            for kind, name, histogram in histograms
+        ]
+
+
+# Gauge values for the stats tab
+def gauge_rows() -> list[list]:
+    return [[name, read()] for name, (_, _, read) in sorted(_gauges.items())]
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Keep scrapes out of the console
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve /metrics on localhost from a background thread
+def serve(port: int = c.METRICS_PORT) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
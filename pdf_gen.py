@@ -1,76 +1,624 @@
+import argparse
+import functools
+import hashlib
+import io
+import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable
 
-from fpdf import FPDF
+import numpy as np
 from PIL import Image
 from tqdm import tqdm
 
+import card_store
 import constants as c
+import imposition
+import metrics
+import sheet_raster
 
 
-def compress_image(image_path: str, dpi: int = 300, quality: int = 90) -> str:
+def compress_image(
+    image_path: str, dpi: int = c.PRINT_DPI, quality: int = c.PRINT_QUALITY
+) -> str:
+    # Use JPEG compression, the settings are part of the name so changing them recompresses
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    compressed_image_filename = f"{stem}_q{quality}_{dpi}dpi.jpg"
+    compressed_image_path = os.path.join(c.COMPRESSED_DIR, compressed_image_filename)
+
+    c.ensure_directories()
+
+    # Skip cards that have not changed since they were last compressed
+    if (
+        os.path.exists(compressed_image_path)
+        and os.stat(compressed_image_path).st_mtime_ns
+        >= os.stat(image_path).st_mtime_ns
+    ):
+        return compressed_image_path
+
     # Open image to PIL
     img = Image.open(image_path).convert("RGB")
 
-    # Use JPEG compression
-    compressed_image_filename = os.path.basename(image_path).replace(".png", ".jpg")
-    compressed_image_path = os.path.join(c.COMPRESSED_DIR, compressed_image_filename)
-
-    # Save to directory
-    img.save(compressed_image_path, "JPEG", quality=quality, dpi=(dpi, dpi))
+    # An interrupted run never leaves a partial JPEG
+    card_store.write_atomic(
+        compressed_image_path,
+        lambda f: img.save(f, "JPEG", quality=quality, dpi=(dpi, dpi)),
+    )
 
     return compressed_image_path
 
 
-def render_pdf():
-    # Get all original image files
-    image_file_paths = sorted(
-        [f for f in os.listdir(c.IMAGES_DIR) if f.endswith(f".{c.IMAGE_EXTENSION}")]
-    )
+# Compress an image to JPEG in memory, for embedding without touching the disk
+def compress_image_to_buffer(
+    image_path: str, dpi: int = c.PRINT_DPI, quality: int = c.PRINT_QUALITY
+) -> io.BytesIO:
+    img = Image.open(image_path).convert("RGB")
 
-    # Create PDF with blank page
-    pdf = FPDF(
-        orientation="portrait", unit=c.UNIT, format=(c.SHEET_RATIO[0], c.SHEET_RATIO[1])
-    )
-    pdf.add_page()
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=quality, dpi=(dpi, dpi))
+    buffer.seek(0)
 
-    # Current row(i) and column(j) in the current page
-    i, j = 0, 0
+    return buffer
 
-    for image_path in tqdm(image_file_paths, desc="Adding images", unit="image(s) "):
 
-        # Compress image before embedding in pdf
-        compressed_image_path = compress_image(os.path.join(c.IMAGES_DIR, image_path))
+# Get a card ready to embed. Cards saved with the JPEG print profile are embedded
+# as they are, with no second decode and encode; anything else is compressed first
+def prepare_image(image_path: str, in_memory: bool = False) -> str | io.BytesIO:
+    if image_path.lower().endswith((".jpg", ".jpeg")):
+        return image_path
+    if in_memory:
+        return compress_image_to_buffer(image_path)
+    return compress_image(image_path)
 
-        if i == c.IMAGE_FREQUENCY[0]:
-            # at the end of a row
-            j += 1
-            if j == c.IMAGE_FREQUENCY[1]:
-                # at the end of a page
-                i, j = 0, 0
-                pdf.add_page()
-            else:
-                i = 0
 
-        # Top-left corner position in sheet
-        x_offset = c.IMAGE_RATIO[0] * i + c.IMAGE_SPACING[0] * (i + 1)
-        y_offset = c.IMAGE_RATIO[1] * j + c.IMAGE_SPACING[1] * (j + 1)
+# Hash of a card's file contents, so identical cards are compressed and embedded once
+def content_hash(image_path: str) -> str:
+    with open(image_path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+# Ways of putting cards into a PDF: every card embedded and placed by the PDF,
+# or each sheet composited into one image first
+PDF_BACKENDS = ("cards", "sheets")
+
+
+# Compress images in parallel, yielding them in the original order.
+# Images not yet compressed are cancelled if the caller stops early
+def compress_all(image_paths: list[str], in_memory: bool = False):
+    with ThreadPoolExecutor(max_workers=c.COMPRESS_WORKERS) as executor:
+        try:
+            yield from executor.map(
+                functools.partial(prepare_image, in_memory=in_memory), image_paths
+            )
+        except BaseException:
+            # Don't start compressing the remaining images when interrupted
+            executor.shutdown(cancel_futures=True)
+            raise
+
+
+# Place cards on a new PDF whose first page is sheet first_sheet of the run.
+# placements are (image, sheet, (x, y)) in sheet order
+def build_pdf(
+    sheet_layouts: list[imposition.SheetLayout],
+    placements,
+    first_sheet: int = 0,
+    on_placed: Callable[[], None] | None = None,
+):
+    # fpdf is slow to import, only load it when a PDF is actually made
+    from fpdf import FPDF
+
+    pdf = FPDF(
+        orientation="portrait",
+        unit=c.UNIT,
+        format=sheet_layouts[first_sheet].sheet_size,
+    )
+    pdf.add_page()
+
+    for image, sheet, (x_offset, y_offset) in placements:
+        while pdf.page < sheet - first_sheet + 1:
+            pdf.add_page(format=sheet_layouts[first_sheet + pdf.page].sheet_size)
 
-        # Embed the image
+        # Embed the image, repeated images reuse the first embedded copy
         pdf.image(
-            compressed_image_path,
+            image,
             x=x_offset,
             y=y_offset,
             w=c.IMAGE_RATIO[0],
             h=c.IMAGE_RATIO[1],
         )
 
-        i += 1
+        if on_placed:
+            on_placed()
+
+    return pdf
+
+
+# Cards on each of sheet_count sheets from first_sheet, as sheet_raster jobs.
+# placements are (card path, sheet, (x, y)) in sheet order
+def sheet_jobs(
+    sheet_layouts: list[imposition.SheetLayout],
+    placements,
+    first_sheet: int = 0,
+    sheet_count: int | None = None,
+) -> list[sheet_raster.SheetJob]:
+    if sheet_count is None:
+        sheet_count = len(sheet_layouts) - first_sheet
+
+    jobs = [
+        (sheet_layouts[sheet].sheet_size, [])
+        for sheet in range(first_sheet, first_sheet + sheet_count)
+    ]
+    for card_path, sheet, (x_offset, y_offset) in placements:
+        jobs[sheet - first_sheet][1].append((card_path, x_offset, y_offset))
+    return jobs
+
+
+# Embed pre-composited sheets in a new PDF, one full-page image per page
+def build_sheet_pdf(
+    sheet_layouts: list[imposition.SheetLayout],
+    sheet_images: list[bytes],
+    first_sheet: int = 0,
+):
+    # fpdf is slow to import, only load it when a PDF is actually made
+    from fpdf import FPDF
+
+    pdf = FPDF(
+        orientation="portrait",
+        unit=c.UNIT,
+        format=sheet_layouts[first_sheet].sheet_size,
+    )
+
+    for sheet, image in enumerate(sheet_images, start=first_sheet):
+        width, height = sheet_layouts[sheet].sheet_size
+        pdf.add_page(format=(width, height))
+        pdf.image(io.BytesIO(image), x=0, y=0, w=width, h=height)
+
+    return pdf
+
+
+# Path of the manifest written next to a chunked print run
+def manifest_path(output: str) -> str:
+    return f"{os.path.splitext(output)[0]}.manifest.json"
+
+
+# Path of one PDF of a chunked print run, numbered from 1
+def chunk_path(output: str, chunk: int) -> str:
+    stem, extension = os.path.splitext(output)
+    return f"{stem}_{chunk + 1:04d}{extension or '.pdf'}"
+
+
+# Render the run as a series of PDFs of at most chunk_pages sheets each, so memory
+# is bounded by one chunk however many cards there are. The manifest records the
+# sheet, file and page of every card and which chunks are finished; running the
+# same job again skips the finished chunks
+def render_chunks(
+    output: str,
+    chunk_pages: int,
+    job: str,
+    sheet_layouts: list[imposition.SheetLayout],
+    card_names: list[str],
+    unique_paths: list[str],
+    card_sources: list[int],
+    placement_cards,
+    placement_sheets,
+    positions,
+    in_memory: bool = False,
+    on_progress: Callable[[int, int], None] | None = None,
+    backend: str = c.PDF_BACKEND,
+):
+    sheet_count = int(placement_sheets[-1]) + 1 if len(placement_sheets) else 1
+    chunk_count = -(-sheet_count // chunk_pages)
+
+    # Chunks finished by an earlier run of the same job
+    finished = set()
+    manifest_file = manifest_path(output)
+    if os.path.exists(manifest_file):
+        with open(manifest_file, encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous.get("job") == job:
+            finished = {
+                chunk["chunk"]
+                for chunk in previous["chunks"]
+                if chunk["done"] and os.path.exists(chunk_path(output, chunk["chunk"]))
+            }
+
+        # A smaller run must not leave the previous run's extra chunks behind
+        for chunk in previous["chunks"]:
+            if chunk["chunk"] >= chunk_count:
+                stale_path = chunk_path(output, chunk["chunk"])
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+
+    # Placements are in sheet order, so each chunk is one slice of them
+    bounds = np.searchsorted(
+        placement_sheets, np.arange(chunk_count + 1) * chunk_pages
+    ).tolist()
+
+    manifest = {
+        "job": job,
+        "chunk_pages": chunk_pages,
+        "chunks": [
+            {
+                "chunk": chunk,
+                "file": os.path.basename(chunk_path(output, chunk)),
+                "sheets": [
+                    chunk * chunk_pages + 1,
+                    min(sheet_count, (chunk + 1) * chunk_pages),
+                ],
+                "cards": bounds[chunk + 1] - bounds[chunk],
+                "done": chunk in finished,
+            }
+            for chunk in range(chunk_count)
+        ],
+        "placements": [
+            {
+                "card": card_names[card],
+                "sheet": sheet + 1,
+                "file": os.path.basename(chunk_path(output, sheet // chunk_pages)),
+                "page": sheet % chunk_pages + 1,
+                "x": x_offset,
+                "y": y_offset,
+            }
+            for card, sheet, (x_offset, y_offset) in zip(
+                placement_cards.tolist(),
+                placement_sheets.tolist(),
+                positions.tolist(),
+            )
+        ],
+    }
+
+    # The manifest is written first so the layout is known even before any chunk is
+    def save_manifest():
+        card_store.write_atomic(manifest_file, json.dumps(manifest, indent=2).encode())
+
+    save_manifest()
+
+    total = len(placement_cards)
+    done = sum(manifest["chunks"][chunk]["cards"] for chunk in finished)
+    if on_progress:
+        on_progress(done, total)
+
+    for chunk in tqdm(range(chunk_count), desc="Writing chunks", unit="chunk(s) "):
+        if chunk in finished:
+            continue
+
+        start, end = bounds[chunk], bounds[chunk + 1]
+        chunk_cards = placement_cards[start:end].tolist()
+
+        first_sheet = chunk * chunk_pages
+        chunk_placements = zip(
+            chunk_cards,
+            placement_sheets[start:end].tolist(),
+            positions[start:end].tolist(),
+        )
+
+        if backend == "sheets":
+            # Only this chunk's sheets are composited and held
+            with metrics.stage("rasterize"):
+                sheet_images = list(
+                    sheet_raster.render_sheets(
+                        sheet_jobs(
+                            sheet_layouts,
+                            (
+                                (unique_paths[card_sources[card]], sheet, position)
+                                for card, sheet, position in chunk_placements
+                            ),
+                            first_sheet,
+                            min(chunk_pages, sheet_count - first_sheet),
+                        )
+                    )
+                )
+
+            with metrics.stage("place"):
+                pdf = build_sheet_pdf(sheet_layouts, sheet_images, first_sheet)
+        else:
+            # Only this chunk's images are compressed and held
+            with metrics.stage("compress"):
+                sources = sorted({card_sources[card] for card in chunk_cards})
+                images = dict(
+                    zip(
+                        sources,
+                        compress_all([unique_paths[s] for s in sources], in_memory),
+                    )
+                )
+
+            with metrics.stage("place"):
+                pdf = build_pdf(
+                    sheet_layouts,
+                    (
+                        (images[card_sources[card]], sheet, position)
+                        for card, sheet, position in chunk_placements
+                    ),
+                    first_sheet,
+                )
+
+        with metrics.stage("write"):
+            card_store.write_atomic(chunk_path(output, chunk), bytes(pdf.output()))
+            manifest["chunks"][chunk]["done"] = True
+            save_manifest()
+
+        done += end - start
+        if on_progress:
+            on_progress(done, total)
+
+    return f"PDF Created Successfully! {chunk_count} file(s), see {manifest_file}"
+
+
+# Key of a print request: every card file by name, size and modification time,
+# with the settings that shape the PDF. Equal keys give the same PDF
+def print_key(
+    cards: list[str] | None = None,
+    copies: int | dict[str, int] = c.PRINT_COPIES,
+    sheets: list[tuple[float, float]] | None = None,
+    backend: str = c.PDF_BACKEND,
+) -> tuple:
+    store = card_store.get_card_store()
+    files = []
+    for filename in sorted(
+        cards
+        if cards is not None
+        else [f for f in store.filenames() if f.endswith(c.OUTPUT_EXTENSIONS)]
+    ):
+        try:
+            stat = os.stat(store.path(filename))
+            files.append((filename, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            files.append((filename, None, None))
+
+    return (
+        tuple(files),
+        tuple(sorted(copies.items())) if isinstance(copies, dict) else copies,
+        tuple(tuple(sheet) for sheet in (sheets or c.SHEET_SIZES)),
+        backend,
+        c.IMAGE_RATIO,
+        c.PRINT_DPI,
+        c.PRINT_QUALITY,
+    )
+
+
+# Render cards into a PDF, written to a file path or a file-like object.
+# cards picks card files from the card store (default: all), copies is how many of
+# each to print (one count for all cards, or per card filename) and sheets are
+# the sheet sizes to use in order, the last one repeating as needed.
+# With in_memory, compressed images are kept in memory instead of COMPRESSED_DIR.
+# With chunk_pages (PDF_CHUNK_PAGES from the command line), the output path is
+# split into resumable PDFs of that many sheets each, see render_chunks.
+# backend "sheets" composites every sheet into one image at PRINT_DPI across
+# processes instead of embedding each card.
+# on_progress(done, total) is called as each image is compressed and then placed
+@metrics.timed_request("render_pdf")
+def render_pdf(
+    output: str | BinaryIO = c.OUTPUT_PDF,
+    in_memory: bool = False,
+    on_progress: Callable[[int, int], None] | None = None,
+    cards: list[str] | None = None,
+    copies: int | dict[str, int] = c.PRINT_COPIES,
+    sheets: list[tuple[float, float]] | None = None,
+    chunk_pages: int = 0,
+    backend: str = c.PDF_BACKEND,
+):
+    if backend not in PDF_BACKENDS:
+        raise ValueError(f"Unknown PDF backend {backend}, use one of {PDF_BACKENDS}")
+
+    # Get all original image files
+    store = card_store.get_card_store()
+    image_file_paths = sorted(
+        cards
+        if cards is not None
+        else [f for f in store.filenames() if f.endswith(c.OUTPUT_EXTENSIONS)]
+    )
+
+    if isinstance(copies, int):
+        copies = {path: copies for path in image_file_paths}
+    card_copies = [
+        max(0, int(copies.get(path, c.PRINT_COPIES))) for path in image_file_paths
+    ]
+
+    # Cards with identical contents share one compressed image
+    with metrics.stage("dedupe"):
+        unique_sources = {}
+        unique_paths = []
+        card_sources = []
+        for path in image_file_paths:
+            image_path = store.path(path)
+            key = content_hash(image_path)
+            if key not in unique_sources:
+                unique_sources[key] = len(unique_paths)
+                unique_paths.append(image_path)
+            card_sources.append(unique_sources[key])
+
+    # Work out every placement up front
+    layouts = [imposition.SheetLayout(sheet) for sheet in (sheets or c.SHEET_SIZES)]
+    placement_cards = imposition.expand_copies(card_copies)
+    sheet_layouts, placement_sheets, positions = imposition.impose(
+        len(placement_cards), layouts
+    )
+
+    if chunk_pages:
+        if not isinstance(output, str):
+            raise ValueError("Chunked printing needs an output path")
+
+        # Everything that decides the chunks' contents, so a changed job starts over
+        job = hashlib.sha256(
+            json.dumps(
+                [
+                    image_file_paths,
+                    list(unique_sources),
+                    card_sources,
+                    card_copies,
+                    [layout.sheet_size for layout in layouts],
+                    chunk_pages,
+                    backend,
+                    c.PRINT_DPI,
+                    c.PRINT_QUALITY,
+                ]
+            ).encode()
+        ).hexdigest()
+
+        return render_chunks(
+            output,
+            chunk_pages,
+            job,
+            sheet_layouts,
+            image_file_paths,
+            unique_paths,
+            card_sources,
+            placement_cards,
+            placement_sheets,
+            positions,
+            in_memory,
+            on_progress,
+            backend,
+        )
+
+    if backend == "sheets":
+        # Each sheet is counted once when composited
+        with metrics.stage("rasterize"):
+            sheet_images = []
+            for sheet_image in tqdm(
+                sheet_raster.render_sheets(
+                    sheet_jobs(
+                        sheet_layouts,
+                        (
+                            (unique_paths[card_sources[card]], sheet, position)
+                            for card, sheet, position in zip(
+                                placement_cards.tolist(),
+                                placement_sheets.tolist(),
+                                positions.tolist(),
+                            )
+                        ),
+                    )
+                ),
+                total=len(sheet_layouts),
+                desc="Compositing sheets",
+                unit="sheet(s) ",
+            ):
+                sheet_images.append(sheet_image)
+                if on_progress:
+                    on_progress(len(sheet_images), len(sheet_layouts))
+
+        with metrics.stage("place"):
+            pdf = build_sheet_pdf(sheet_layouts, sheet_images)
+
+        with metrics.stage("write"):
+            if isinstance(output, str):
+                pdf.output(output)
+            else:
+                output.write(pdf.output())
+
+        return "PDF Created Successfully!"
+
+    # Each unique image is counted once when compressed, and each placement once
+    total_steps = len(unique_paths) + len(placement_cards)
+
+    # Compress images before embedding in pdf, in parallel and in the original order
+    with metrics.stage("compress"):
+        compressed_images = []
+        for compressed_image in tqdm(
+            compress_all(unique_paths, in_memory),
+            total=len(unique_paths),
+            desc="Compressing images",
+            unit="image(s) ",
+        ):
+            compressed_images.append(compressed_image)
+            if on_progress:
+                on_progress(len(compressed_images), total_steps)
+
+    done = len(compressed_images)
+
+    # Count each placement as it is embedded
+    def on_placed():
+        nonlocal done
+        done += 1
+        if on_progress:
+            on_progress(done, total_steps)
+
+    # Create PDF with the first sheet, adding the others as cards reach them
+    with metrics.stage("place"):
+        pdf = build_pdf(
+            sheet_layouts,
+            (
+                (compressed_images[card_sources[card]], sheet, position)
+                for card, sheet, position in tqdm(
+                    zip(placement_cards, placement_sheets, positions.tolist()),
+                    total=len(placement_cards),
+                    desc="Adding images",
+                    unit="image(s) ",
+                )
+            ),
+            on_placed=on_placed,
+        )
 
     # Save PDF
-    pdf.output(c.OUTPUT_PDF)
+    with metrics.stage("write"):
+        if isinstance(output, str):
+            pdf.output(output)
+        else:
+            output.write(pdf.output())
 
     return "PDF Created Successfully!"
 
 
+# Parse a sheet size such as 12x18
+def parse_sheet_size(value: str) -> tuple[float, float]:
+    width, height = value.lower().split("x")
+    return float(width), float(height)
+
+
 if __name__ == "__main__":
-    render_pdf()
+    parser = argparse.ArgumentParser(description="Print all ID cards to a PDF")
+    parser.add_argument(
+        "--output", default=c.OUTPUT_PDF, help="PDF path, or - to write to stdout"
+    )
+    parser.add_argument(
+        "--in-memory",
+        action="store_true",
+        help=f"Compress images in memory instead of through {c.COMPRESSED_DIR}",
+    )
+    parser.add_argument(
+        "--cards",
+        nargs="+",
+        default=None,
+        help=f"Card files in {c.IMAGES_DIR} to print (default: all)",
+    )
+    parser.add_argument(
+        "--copies", type=int, default=c.PRINT_COPIES, help="Copies of each card"
+    )
+    parser.add_argument(
+        "--chunk-pages",
+        type=int,
+        default=c.PDF_CHUNK_PAGES,
+        help="Split the output into resumable PDFs of this many sheets, with a "
+        "manifest of where every card was placed (default: one PDF)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=PDF_BACKENDS,
+        default=c.PDF_BACKEND,
+        help="Embed every card, or one image per sheet composited at "
+        f"{c.PRINT_DPI} DPI across processes",
+    )
+    parser.add_argument(
+        "--sheet",
+        type=parse_sheet_size,
+        action="append",
+        default=None,
+        help=f"Sheet size in {c.UNIT} such as 12x18, repeat for mixed sheets "
+        "(the last one is used for the remaining pages)",
+    )
+    args = parser.parse_args()
+
+    output = sys.stdout.buffer if args.output == "-" else args.output
+    print(
+        render_pdf(
+            output,
+            args.in_memory,
+            cards=args.cards,
+            copies=args.copies,
+            sheets=args.sheet,
+            chunk_pages=args.chunk_pages,
+            backend=args.backend,
+        ),
+        file=sys.stderr,
+    )
@@ -0,0 +1,90 @@
+import functools
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+import numpy as np
+from PIL import Image
+
+import constants as c
+
+# Units accepted for UNIT, in units per inch
+UNITS_PER_INCH = {"in": 1.0, "cm": 2.54, "mm": 25.4, "pt": 72.0}
+
+# Cards on one sheet: the sheet size and every (card path, x, y), all in UNIT
+SheetJob = tuple[tuple[float, float], list[tuple[str, float, float]]]
+
+
+# Convert a length in UNIT to pixels at dpi
+def to_pixels(length: float, dpi: int = c.PRINT_DPI) -> int:
+    return round(length / UNITS_PER_INCH[c.UNIT] * dpi)
+
+
+# Decode a card and resize it to its printed size. Kept per process, so a card
+# repeated over many sheets is only decoded and resized once
+def load_card(card_path: str, size: tuple[int, int]) -> np.ndarray:
+    # A regenerated card keeps its path, so key on its modification too
+    stat = os.stat(card_path)
+    return _load_card(card_path, stat.st_mtime_ns, stat.st_size, size)
+
+
+@functools.lru_cache(maxsize=c.SHEET_RASTER_CARD_CACHE)
+def _load_card(
+    card_path: str, mtime_ns: int, file_size: int, size: tuple[int, int]
+) -> np.ndarray:
+    with Image.open(card_path) as image:
+        card = image.convert("RGB")
+        if card.size != size:
+            card = card.resize(size, Image.Resampling.LANCZOS)
+        return np.asarray(card)
+
+
+# Composite every card of a sheet onto white at dpi and encode it as one JPEG
+def render_sheet(
+    job: SheetJob, dpi: int = c.PRINT_DPI, quality: int = c.PRINT_QUALITY
+) -> bytes:
+    sheet_size, cards = job
+    sheet = np.full(
+        (to_pixels(sheet_size[1], dpi), to_pixels(sheet_size[0], dpi), 3),
+        255,
+        dtype=np.uint8,
+    )
+    card_size = (to_pixels(c.IMAGE_RATIO[0], dpi), to_pixels(c.IMAGE_RATIO[1], dpi))
+
+    for card_path, x, y in cards:
+        left, top = to_pixels(x, dpi), to_pixels(y, dpi)
+
+        # Rounding can push the last slot a pixel past the edge, clip it to the sheet
+        region = sheet[top : top + card_size[1], left : left + card_size[0]]
+        region[...] = load_card(card_path, card_size)[
+            : region.shape[0], : region.shape[1]
+        ]
+
+    buffer = io.BytesIO()
+    Image.fromarray(sheet).save(buffer, "JPEG", quality=quality, dpi=(dpi, dpi))
+    return buffer.getvalue()
+
+
+# Render sheets across worker processes, yielding their JPEGs in order
+def render_sheets(
+    jobs: list[SheetJob],
+    dpi: int = c.PRINT_DPI,
+    quality: int = c.PRINT_QUALITY,
+    workers: int = c.SHEET_RASTER_WORKERS,
+) -> Iterator[bytes]:
+    render = functools.partial(render_sheet, dpi=dpi, quality=quality)
+
+    # Starting processes costs more than a single sheet takes
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        yield from map(render, jobs)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            yield from executor.map(render, jobs)
+        except BaseException:
+            # Don't start rendering the remaining sheets when interrupted
+            executor.shutdown(cancel_futures=True)
+            raise
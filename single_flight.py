@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Hashable
+
+import constants as c
+import metrics
+
+
+class SingleFlight:
+    """Runs one call per key at a time. Callers with the same key while it runs
+    wait for it and share its result or exception, and its result answers
+    repeats for ttl seconds afterwards."""
+
+    def __init__(
+        self,
+        name: str,
+        ttl: float = c.COALESCE_TTL_SECONDS,
+        max_results: int = c.COALESCE_MAX_RESULTS,
+    ):
+        self.ttl = ttl
+        self.max_results = max_results
+        self.coalesced = 0
+        self.cached = 0
+
+        self._in_flight: dict[Hashable, Future] = {}
+        self._results: OrderedDict[Hashable, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        metrics.register_gauge(
+            f"id_card_{name}_coalesced_total",
+            f"{name} requests that waited for an identical one in flight",
+            lambda: self.coalesced,
+            "counter",
+        )
+        metrics.register_gauge(
+            f"id_card_{name}_result_cache_hits_total",
+            f"{name} requests answered by a recent identical result",
+            lambda: self.cached,
+            "counter",
+        )
+
+    # Call fn(*args, **kwargs) unless an identical call is running or just ran.
+    # valid(result) can reject a recent result, e.g. when its file was deleted since
+    def do(
+        self,
+        key: Hashable,
+        fn: Callable,
+        *args,
+        valid: Callable[[object], bool] | None = None,
+        **kwargs,
+    ):
+        with self._lock:
+            found, result = self._recent(key, valid)
+            if found:
+                return result
+
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            self._remember(key, result)
+        future.set_result(result)
+
+        return result
+
+    # Recent result for key as (found, result), for callers that coalesce
+    # running calls themselves and only want the result cache
+    def recent(
+        self, key: Hashable, valid: Callable[[object], bool] | None = None
+    ) -> tuple[bool, object]:
+        with self._lock:
+            return self._recent(key, valid)
+
+    # Keep a result to answer repeats of key for ttl seconds
+    def remember(self, key: Hashable, result):
+        with self._lock:
+            self._remember(key, result)
+
+    def _recent(self, key: Hashable, valid: Callable[[object], bool] | None):
+        self._drop_expired()
+
+        if key in self._results:
+            result = self._results[key][1]
+            if valid is None or valid(result):
+                self.cached += 1
+                return True, result
+            del self._results[key]
+
+        return False, None
+
+    def _remember(self, key: Hashable, result):
+        self._results[key] = (time.monotonic() + self.ttl, result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+    # Results are stored in the order they expire
+    def _drop_expired(self):
+        now = time.monotonic()
+        while self._results and next(iter(self._results.values()))[0] <= now:
+            self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
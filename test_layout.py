@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import layout
+
+# Details that fit from the set text position, and ones wide enough to be centered
+DETAILS = [
+    {"name": "Jane Doe", "phone": "98765 43210", "post": "Manager"},
+    {
+        "name": "Bartholomew Maximilian Wolfeschlegelsteinhausen",
+        "phone": "98765 43210",
+        "post": "General Secretary And Treasurer",
+    },
+]
+
+
+# A square photo with detail in every pixel, so any misplaced paste shows
+def make_photo() -> Image.Image:
+    gradient = np.arange(400, dtype=np.uint8).reshape(20, 20)
+    return Image.fromarray(np.dstack([gradient, gradient.T, 255 - gradient])).resize(
+        (500, 500)
+    )
+
+
+# Cards pasting the pre-rendered heading and colon layer match drawing them directly
+@pytest.mark.parametrize("template", layout.available_templates())
+@pytest.mark.parametrize("values", DETAILS)
+def test_static_layer_matches_direct_drawing(template, values):
+    plan = layout.get_layout_plan(template)
+    photo = make_photo()
+
+    layered = plan.render(photo, values)
+
+    # The default layout places its text clear of the photo, so the layer is used
+    if template == layout.DEFAULT_TEMPLATE:
+        assert plan._static_layers and any(plan._static_layers.values())
+
+    direct = plan.composite(photo)
+    plan.static_layer = lambda text_position: None
+    try:
+        plan.draw_text(direct, values)
+    finally:
+        del plan.static_layer
+
+    assert np.array_equal(np.asarray(layered), np.asarray(direct))
@@ -0,0 +1,49 @@
+import os
+
+from PIL import Image
+
+import card_store
+import constants as c
+
+
+# Path of the thumbnail for a card, one per card file
+def thumbnail_path(card_path: str) -> str:
+    stem = os.path.splitext(os.path.basename(card_path))[0]
+    return os.path.join(c.THUMBNAILS_DIR, f"{stem}.jpg")
+
+
+# Make a thumbnail for a card, from the already rendered image when given
+def create_thumbnail(card_path: str, image: Image.Image | None = None) -> str:
+    c.ensure_directories()
+    path = thumbnail_path(card_path)
+
+    if image is None:
+        image = Image.open(card_path)
+
+    preview = image.convert("RGB") if image.mode != "RGB" else image.copy()
+    preview.thumbnail(c.THUMBNAIL_SIZE)
+
+    card_store.write_atomic(
+        path, lambda f: preview.save(f, "JPEG", quality=c.THUMBNAIL_QUALITY)
+    )
+
+    return path
+
+
+# Get the thumbnail for a card, remaking it if the card changed since
+def get_thumbnail(card_path: str) -> str:
+    path = thumbnail_path(card_path)
+
+    if (
+        os.path.exists(path)
+        and os.stat(path).st_mtime_ns >= os.stat(card_path).st_mtime_ns
+    ):
+        return path
+
+    return create_thumbnail(card_path)
+
+
+def delete_thumbnail(card_path: str):
+    path = thumbnail_path(card_path)
+    if os.path.exists(path):
+        os.remove(path)